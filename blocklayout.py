@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""Block placement. Reorders the BBs of each function so that the most
+frequent edges become fall-throughs, using the estimated (or profiled)
+execution frequency of the BBs.
+
+The edges are visited from the most frequent one, and each edge joins the
+chain of BBs ending at its source with the chain starting at its destination
+(Pettis and Hansen). Back edges are never made fall-throughs: the loops
+are already rotated so that they are tested at the bottom. The chains are then placed one after the other,
+preferring the chains which continue the innermost loop being placed, so
+that loop bodies stay contiguous. Finally the branches are fixed to match
+the new order: branches to the next BB are removed, conditional branches are
+inverted when their target is placed next, and jumps are added where a
+fall-through edge was broken."""
+
+from ir import *
+from regalloc import block_frequencies
+
+
+def innermost_loops(cfg, func):
+    """Map each BB of a function to the innermost loop containing it"""
+    res = {}
+    for loop in reversed(cfg.analyses.loops(func)):
+        for bb in loop.blocks:
+            res[bb] = loop
+    return res
+
+
+class BlockLayout(object):
+    """Placement of the BBs of a single function"""
+
+    def __init__(self, cfg, func, freq, stats):
+        self.cfg = cfg
+        self.blocks = cfg.function_blocks(func)
+        self.loops = innermost_loops(cfg, func)
+        self.preds = cfg.predecessors()
+        self.dom = cfg.analyses.dominators(func)
+        self.freq = freq
+        self.stats = stats
+
+    def chains(self):
+        """Join the BBs into chains along the most frequent edges"""
+        position = {bb: n for n, bb in enumerate(self.blocks)}
+        edges = []
+        for bb in self.blocks:
+            for s in set(bb.succ()) - set(self.dom[bb]):
+                # prefer the edges which are already fall-throughs, then the
+                # original order
+                edges.append((-min(self.freq[bb], self.freq[s]), s is not bb.next, position[bb], bb, s))
+        edges.sort(key=lambda e: e[:3])
+        entry, final = self.blocks[0], self.blocks[-1]
+        chain = {bb: [bb] for bb in self.blocks}
+        for w, taken, pos, src, dst in edges:
+            a, b = chain[src], chain[dst]
+            if a is b or a[-1] is not src or b[0] is not dst or dst is entry:
+                continue
+            if a[0] is entry and b[-1] is final:
+                # the other chains could be placed neither before nor after
+                continue
+            a += b
+            for bb in b:
+                chain[bb] = a
+        res = []
+        for bb in self.blocks:
+            if chain[bb][0] is bb:
+                res.append(chain[bb])
+        return res
+
+    def place(self, chains):
+        """Order the chains, starting from the one of the entry BB; the last BB
+        of the function falls through to the epilogue, so its chain is placed
+        last"""
+        order = chains[0]
+        final = [c for c in chains if self.blocks[-1] in c][0]
+        rest = [c for c in chains[1:] if c is not final]
+        while rest:
+            loop = self.loops.get(order[-1])
+            placed = set(order)
+
+            def score(c):
+                inloop = loop is not None and c[0] in loop
+                weight = sum([self.freq[p] for p in self.preds[c[0]] if p in placed])
+                return inloop, weight
+
+            best = max(rest, key=score)
+            rest.remove(best)
+            order = order + best
+        return order + final
+
+    def remove_branch(self, bb):
+        bb.remove_instrs({bb.instrs[-1]})
+        bb.target = None
+        bb.target_bb = None
+        self.stats['removed'] += 1
+
+    def fix_branches(self, order):
+        """Make the code of each BB agree with the BB placed after it"""
+        k = 0
+        while k < len(order):
+            bb = order[k]
+            follow = order[k + 1] if k + 1 < len(order) else None
+            last = bb.instrs[-1]
+            if bb.ends_with_branch() and last.is_unconditional():
+                if bb.target_bb is follow:
+                    self.remove_branch(bb)
+                    bb.next = follow
+            elif bb.ends_with_branch():
+                if bb.target_bb is bb.next:
+                    self.remove_branch(bb)
+                elif bb.target_bb is follow:
+                    last.negcond = not last.negcond
+                    last.target = bb.next.get_entry_label()
+                    bb.target = last.target
+                    bb.target_bb, bb.next = bb.next, follow
+                    self.stats['inverted'] += 1
+                elif bb.next is not follow:
+                    # a conditional branch cannot be followed by a jump in
+                    # the same BB
+                    jump = self.cfg.new_jump_block(bb, bb.next)
+                    bb.next = jump
+                    order.insert(k + 1, jump)
+                    self.stats['jumps'] += 1
+            if not bb.ends_with_branch() and bb.next is not None and bb.next is not follow \
+                    and not getattr(last, 'tail', False):
+                label = bb.next.get_entry_label()
+                bb.append_instrs([BranchStat(None, None, label, last.symtab)])
+                bb.target = label
+                bb.target_bb = bb.next
+                bb.next = None
+                self.stats['jumps'] += 1
+            k += 1
+        return order
+
+    def __call__(self):
+        if len(self.blocks) == 1 or len([bb for bb in self.blocks if not bb.succ()]) > 1 or self.blocks[-1].succ():
+            # nothing to move, or the end of the function cannot be identified
+            return self.blocks
+        order = self.place(self.chains())
+        self.stats['moved'] += len([bb for bb, old in zip(order, self.blocks) if bb is not old])
+        return self.fix_branches(order)
+
+
+def block_layout(cfg, profile=None):
+    """Reorder the BBs of all the functions. 'profile' maps each BB to its
+    execution count, if available. Returns the statistics of the pass."""
+    freq = block_frequencies(cfg, profile)
+    stats = {'moved': 0, 'removed': 0, 'inverted': 0, 'jumps': 0}
+    layout = []
+    for func in cfg.heads():
+        layout += BlockLayout(cfg, func, freq, stats)()
+    cfg[:] = layout
+    cfg.invalidate()
+    cfg.update_ir()
+    print('Block layout: moved', stats['moved'], 'BBs, removed', stats['removed'], 'branches, inverted',
+          stats['inverted'], 'branches, added', stats['jumps'], 'jumps')
+    return stats
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""Call graph of the program, and whole-program elimination of the procedures
+which cannot be reached from the main block and of the global variables
+which are not referenced by any reachable code.
+
+The main block is identified by the 'global' key, like in
+IRNode.get_function(). The call graph can be built both before and after
+lowering: calls are CallStat nodes in the first case, and BranchStat nodes
+with returns=True in the second."""
+
+from ir import *
+from support import get_node_list
+
+
+def called_procedures(node):
+    """Symbols of the procedures called in the IR subtree rooted in 'node'"""
+    res = []
+    for n in get_node_list(node):
+        if isinstance(n, CallStat):
+            callee = n.call.symbol
+        elif isinstance(n, BranchStat) and n.returns:
+            callee = n.target
+        else:
+            continue
+        if callee not in res:
+            res.append(callee)
+    return res
+
+
+def referenced_symbols(node):
+    """Symbols accessed in the IR subtree rooted in 'node'"""
+    res = set()
+    for n in get_node_list(node):
+        for sym in [getattr(n, 'symbol', None), getattr(n, 'dest', None)]:
+            if isinstance(sym, Symbol):
+                res.add(sym)
+    return res
+
+
+class CallGraph(object):
+    def __init__(self, root):
+        self.root = root
+        self.procedures = {fdef.symbol: fdef for fdef in root.defs.children}
+        self.calls = {'global': called_procedures(root.body)}
+        for sym, fdef in self.procedures.items():
+            self.calls[sym] = called_procedures(fdef.body)
+
+    def code(self, proc):
+        """IR subtree containing the code of a procedure"""
+        return self.root.body if proc == 'global' else self.procedures[proc].body
+
+    def callees(self, proc):
+        return [callee for callee in self.calls[proc] if callee in self.calls]
+
+    def reachable(self, start='global'):
+        """Procedures which can be reached by a chain of calls from 'start'
+        (included)"""
+        res = [start]
+        i = 0
+        while i < len(res):
+            for callee in self.callees(res[i]):
+                if callee not in res:
+                    res.append(callee)
+            i += 1
+        return res
+
+    def is_recursive(self, proc):
+        """True if the procedure can call itself, directly or not"""
+        return any([proc in self.reachable(callee) for callee in self.callees(proc)])
+
+    def __repr__(self):
+        res = ''
+        for proc, callees in self.calls.items():
+            name = proc if proc == 'global' else proc.name
+            res += name + ' -> ' + ', '.join([c.name for c in callees]) + '\n'
+        return res
+
+
+def eliminate_dead_procedures(root):
+    """Remove the procedures not reachable from the main block, and the global
+    variables not referenced by the remaining code"""
+    callgraph = CallGraph(root)
+    print(callgraph)
+    live = callgraph.reachable()
+    dead = [fdef for fdef in root.defs.children if fdef.symbol not in live]
+    root.defs.children = [fdef for fdef in root.defs.children if fdef.symbol in live]
+
+    used = set()
+    for proc in live:
+        used |= referenced_symbols(callgraph.code(proc))
+    unused = [sym for sym in root.symtab if sym.stype.size != 0 and sym not in used]
+    # the symbol table is shared with the procedures (global_symtab)
+    root.symtab[:] = [sym for sym in root.symtab if sym not in unused]
+    print('Dead procedure elimination: removed', len(dead), 'procedures and', len(unused), 'global variables')
+    return dead, unused
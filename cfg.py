@@ -5,6 +5,8 @@ Includes cfg construction and liveness analysis.'''
 
 from functools import reduce
 
+from dataflow import Numbering, solve, reverse_postorder
+from loops import AnalysisCache
 from support import get_node_list
 
 
@@ -20,7 +22,8 @@ class BasicBlock(object):
         else:
             self.instrs = []
         try:
-            self.target = self.instrs[-1].target
+            # calls return to the next instruction, so they do not end the BB
+            self.target = None if self.instrs[-1].returns else self.instrs[-1].target
         except Exception:
             self.target = None
         if labels:
@@ -29,25 +32,63 @@ class BasicBlock(object):
             self.labels = []
         self.target_bb = None
 
-        # liveness in respect to the whole cfg
-        self.live_in = set([])
-        self.live_out = set([])
+        # liveness in respect to the whole cfg, as bit vectors over the
+        # variables numbered in 'variables'
+        self.variables = None
+        self.live_in_mask = 0
+        self.live_out_mask = 0
+        self.instr_live = None  # instruction -> (live_in, live_out)
 
-        # compute kill and gen set for this block, as if it was a black box
-        self.kill = set([])  # assigned
-        self.gen = set([])  # use before assign
-        for i in instrs:
+    def compute_gen_kill(self, variables):
+        """Compute kill and gen set for this block, as if it was a black box.
+        The sets are bit vectors, with the bits given by 'variables'."""
+        self.variables = variables
+        kill = set([])  # assigned
+        gen = set([])  # use before assign
+        for i in self.instrs:
             uses = set(i.collect_uses())
             try:
                 kills = set(i.collect_kills())
             except AttributeError:
                 kills = set()
-            #print(i.human_repr(), uses, kills)
-            uses.difference_update(self.kill)
-            self.gen.update(uses)
-            self.kill |= kills
+            uses.difference_update(kill)
+            gen.update(uses)
+            kill |= kills
+        self.gen = variables.mask(gen)
+        self.kill = variables.mask(kill)
         # Total number of registers needed
-        self.total_vars_used = len(self.gen.union(self.kill))
+        self.total_vars_used = len(gen.union(kill))
+
+    def __deepcopy__(self, memo):
+        # statements refer to their BB; copies of statements share it
+        return self
+
+    def decode(self, mask):
+        return self.variables.decode(mask) if self.variables else set()
+
+    @property
+    def live_in(self):
+        return self.decode(self.live_in_mask)
+
+    @property
+    def live_out(self):
+        return self.decode(self.live_out_mask)
+
+    def remove_instrs(self, dead):
+        """Remove the instructions in 'dead' from this BB. Labels of removed
+        instructions are moved to an EmptyStat, so that branches to this BB are
+        still valid; for the same reason a BB never becomes empty."""
+        from ir import EmptyStat
+        instrs = []
+        for i in self.instrs:
+            if i not in dead:
+                instrs.append(i)
+            elif i.get_label() or (len(instrs) == 0 and i is self.instrs[-1]):
+                placeholder = EmptyStat(i.parent, symtab=i.symtab)
+                if i.get_label():
+                    placeholder.set_label(i.get_label())
+                instrs.append(placeholder)
+        self.instrs = instrs
 
     def __repr__(self):
         """Print in graphviz dot format"""
@@ -67,38 +108,34 @@ class BasicBlock(object):
     def succ(self):
         return [s for s in [self.target_bb, self.next] if s]
 
-    def liveness_iteration(self):
-        """Compute live_in and live_out approximation
-        Returns: check of fixed point"""
-        lin = len(self.live_in)
-        lout = len(self.live_out)
-        if self.next or self.target_bb:
-            self.live_out = reduce(lambda x, y: x.union(y), [s.live_in for s in self.succ()], set([]))
-        else:  # Consider live out all the global vars
-            func = self.get_function()
-            if func != 'global':
-                self.live_out = set(func.get_global_symbols())
-        self.live_in = self.gen.union(self.live_out - self.kill)
-        return not (lin == len(self.live_in) and lout == len(self.live_out))
-
     def compute_instr_level_liveness(self):
-        """Compute live_in and live_out for each instruction"""
+        """Compute live_in and live_out for each instruction. This is done
+        the first time the liveness of one of the instructions is needed."""
         currently_alive = self.live_out
+        self.instr_live = {}
         for i in reversed(self.instrs):
-            i.live_out = set(currently_alive)
+            live_out = set(currently_alive)
             try:
                 currently_alive -= set(i.collect_kills())
             except AttributeError:
                 pass
             currently_alive |= set(i.collect_uses())
-            i.live_in = set(currently_alive)
+            self.instr_live[i] = (set(currently_alive), live_out)
         if not currently_alive == self.live_in:
             raise Exception('Instruction level liveness or block level liveness incorrect')
 
+    def instr_liveness(self, instr):
+        """The (live_in, live_out) sets of an instruction of this BB"""
+        if self.instr_live is None:
+            self.compute_instr_level_liveness()
+        if instr not in self.instr_live:
+            raise AttributeError('no liveness information')
+        return self.instr_live[instr]
+
     def remove_useless_next(self):
         """Check if unconditional branch, in that case remove next"""
         try:
-            if self.instrs[-1].is_unconditional():
+            if self.instrs[-1].is_unconditional() and not self.instrs[-1].returns:
                 self.next = None
         except AttributeError:
             pass
@@ -106,6 +143,93 @@ class BasicBlock(object):
     def get_function(self):
         return self.instrs[0].get_function()
 
+    def get_entry_label(self):
+        """Return a label referring to this BB, creating it if necessary"""
+        if len(self.labels):
+            return self.labels[0]
+        from ir import TYPENAMES, EmptyStat
+        if self.instrs[0].get_label():
+            label = self.instrs[0].get_label()
+        else:
+            label = TYPENAMES['label']()
+            if not isinstance(self.instrs[0], EmptyStat):
+                self.instrs.insert(0, EmptyStat(self.instrs[0].parent, symtab=self.instrs[0].symtab))
+            self.instrs[0].set_label(label)
+        self.labels.append(label)
+        return label
+
+    def ends_with_branch(self):
+        """True if the last instruction is a branch (not a call)"""
+        from ir import BranchStat
+        return isinstance(self.instrs[-1], BranchStat) and not self.instrs[-1].returns
+
+    def prepend_instrs(self, instrs):
+        """Insert instructions at the beginning of the BB, after its labels"""
+        first = self.instrs[0]
+        for i in instrs:
+            i.parent = first.parent
+        label = first.get_label()
+        if label:
+            first.label = None
+            instrs[0].set_label(label)
+        self.instrs = instrs + self.instrs
+
+    def append_instrs(self, instrs):
+        """Insert instructions at the end of the BB, before the final branch"""
+        for i in instrs:
+            i.parent = self.instrs[0].parent
+        if self.ends_with_branch():
+            self.instrs = self.instrs[:-1] + instrs + self.instrs[-1:]
+        else:
+            self.instrs += instrs
+
+    def forward_value(self, instr, var, holder, uses, replace=False):
+        """Make 'var' take the value of 'holder' right after 'instr' (or in
+        place of it, if 'replace' is True). The uses of 'var' are renamed when
+        possible; otherwise a copy is inserted. 'uses' maps each temporary to
+        the list of (BB, instruction) pairs using it.
+        Returns True iff a copy was inserted."""
+        from ir import UnaryStat
+        pos = self.instrs.index(instr)
+        varuses = uses.get(var, [])
+        renamable = all([ubb is self for ubb, ui in varuses])
+        if renamable and len(varuses):
+            positions = [self.instrs.index(ui) for ubb, ui in varuses]
+            if min(positions) <= pos:
+                renamable = False
+            for i in self.instrs[pos + 1:max(positions)]:
+                try:
+                    kills = i.collect_kills()
+                except AttributeError:
+                    kills = []
+                if holder in kills or var in kills:
+                    renamable = False
+        if renamable:
+            for ubb, ui in varuses:
+                ui.replace_uses({var: holder})
+            if replace:
+                self.remove_instrs({instr})
+            return False
+        copy = UnaryStat(dest=var, op='plus', src=holder, symtab=instr.symtab)
+        copy.parent = instr.parent
+        if replace:
+            label = instr.get_label()
+            if label:
+                copy.set_label(label)
+            self.instrs[pos] = copy
+        else:
+            self.instrs.insert(pos + 1, copy)
+        return True
+
+    def redirect(self, old, new):
+        """Make the edges of this BB going to 'old' go to 'new' instead"""
+        if self.target_bb is old:
+            self.target = new.get_entry_label()
+            self.target_bb = new
+            self.instrs[-1].target = self.target
+        if self.next is old:
+            self.next = new
+
 
 def stat_list_to_bb(sl):
     """Support function for converting AST StatList to BBs"""
@@ -151,42 +275,104 @@ def remove_non_regs(set):
     return {var for var in set if var.alloct == 'reg'}
 
 
+def is_call(instr):
+    """True if the instruction is a call, which clobbers the caller-saved
+    registers and the link register; divisions by non-constant divisors call
+    the runtime"""
+    from ir import PrintCommand, ReadCommand, BranchStat, BinStat
+    if isinstance(instr, BinStat):
+        return instr.op == 'slash' and instr.imm is None
+    return isinstance(instr, (PrintCommand, ReadCommand)) or (isinstance(instr, BranchStat) and instr.returns)
+
+
 class CFG(list):
-    """Control Flow Graph representation"""
+    """Control Flow Graph representation.
+
+    The CFG keeps an index of its graph: the label map, the successor and
+    predecessor lists of each BB (indexed by BB.number, the position of the
+    BB in the CFG), the entry BB of each function and the reverse postorder.
+    The index is built in time linear in the size of the CFG, and rebuilt
+    on demand after the methods which add BBs or change edges.
+    The dominator trees and loops of the functions are kept in 'analyses',
+    until the CFG of the function changes."""
 
     def __init__(self, root):
         super().__init__()
         from ir import StatList
         stat_lists = [n for n in get_node_list(root) if isinstance(n, StatList)]
-        self += sum([stat_list_to_bb(sl) for sl in stat_lists], [])
+        for sl in stat_lists:
+            self += stat_list_to_bb(sl)
+        self.interprocedural = False  # set when the calls have mod/ref summaries
+        self.variables = Numbering()  # bits of the liveness sets
+        self.analyses = AnalysisCache(self)
+        self.stale = True
         for bb in self:
             if bb.target:
                 bb.target_bb = self.find_target_bb(bb.target)
             bb.remove_useless_next()
+        # the label map was built by the first lookup; now index the edges
+        self.build_index()
+
+    def build_index(self):
+        """Number the BBs, and compute the label map, the successor and
+        predecessor lists, the function entries and the reverse postorder"""
+        self.labelmap = {}
+        self.succs = []
+        self.preds = []
+        self.entries = {}  # function ('global' for the main block) -> entry BB
+        self.blocks = {}  # function -> its BBs, in CFG order
+        funcs = {}  # StatList -> function
+        for n, bb in enumerate(self):
+            bb.number = n
+            for label in bb.labels:
+                self.labelmap[label] = bb
+            self.succs.append([])
+            self.preds.append([])
+            # the entry of a function is its first BB
+            sl = bb.instrs[0].parent
+            if sl not in funcs:
+                funcs[sl] = bb.get_function()
+                self.entries[funcs[sl]] = bb
+                self.blocks[funcs[sl]] = []
+            self.blocks[funcs[sl]].append(bb)
+        for bb in self:
+            for s in bb.succ():
+                if s not in self.succs[bb.number]:
+                    self.succs[bb.number].append(s)
+                    self.preds[s.number].append(bb)
+        # visit the functions from their entries first, then the BBs which
+        # cannot be reached
+        self.rpo = reverse_postorder(list(self.entries.values()) + list(self), lambda bb: self.succs[bb.number])
+        for n, bb in enumerate(self.rpo):
+            bb.rpo = n
+        self.stale = False
+
+    def update_index(self):
+        if self.stale:
+            self.build_index()
+
+    def invalidate(self, func=None):
+        """Must be called by the passes which add BBs to a function ('global'
+        for the main block) or change its edges; None stands for all the
+        functions"""
+        self.stale = True
+        self.analyses.invalidate(func)
+
+    def function_blocks(self, func):
+        """The BBs of a function in CFG order, starting from the entry"""
+        self.update_index()
+        return list(self.blocks[func])
 
     def heads(self):
-        """Get bbs that are only reached via function call or global entry point"""
-        defs = []
-        for bb1 in self:
-            head = True
-            for bb2 in self:
-                if bb2.next == bb1 or bb2.target_bb == bb1:
-                    head = False
-                    break
-            if head:
-                defs.append(bb1)
-        from ir import FunctionDef
-        res = {}
-        for bb in defs:
-            first = bb.instrs[0]
-            parent = first.parent
-            while parent and type(parent) != FunctionDef:
-                parent = parent.parent
-            if not parent:
-                res['global'] = bb
-            else:
-                res[parent] = bb
-        return res
+        """Return a dictionary which maps each function ('global' for the main
+        block) to its entry BB"""
+        self.update_index()
+        return dict(self.entries)
+
+    def reverse_postorder(self):
+        """The BBs in reverse postorder, function by function"""
+        self.update_index()
+        return list(self.rpo)
 
     def print_cfg_to_dot(self, filename):
         """Print the CFG in graphviz dot to file"""
@@ -210,8 +396,8 @@ class CFG(list):
         print('Liveness sets')
         for bb in self:
             print(bb)
-            print('gen:', bb.gen)
-            print('kill:', bb.kill)
+            print('gen:', bb.decode(bb.gen))
+            print('kill:', bb.decode(bb.kill))
             print('live_in:', bb.live_in)
             print('live_out:', bb.live_out)
         print()
@@ -226,19 +412,163 @@ class CFG(list):
     def find_target_bb(self, label):
         """Return the BB that contains a given label;
         Support function for creating/exploring the CFG"""
+        self.update_index()
+        if label not in self.labelmap:
+            raise Exception(repr(label) + ' not found in any BB!')
+        return self.labelmap[label]
+
+    def predecessors(self):
+        """Return a dictionary which maps each BB to the list of its predecessors"""
+        self.update_index()
+        return {bb: list(self.preds[bb.number]) for bb in self}
+
+    def collect_uses(self):
+        """Return a dictionary which maps each variable to the list of
+        (BB, instruction) pairs which use it"""
+        uses = {}
         for bb in self:
-            if label in bb.labels:
-                return bb
-        raise Exception(repr(label) + ' not found in any BB!')
+            for i in bb.instrs:
+                for var in i.collect_uses():
+                    uses.setdefault(var, []).append((bb, i))
+        return uses
 
-    def liveness(self):
-        """Standard live variable analysis"""
-        out = []
+    def functions(self):
+        """Group the BBs by the function they belong to. Returns a list of lists
+        of BBs in CFG order; the first BB of each list is the entry point of the
+        function."""
+        funcs = []
+        content = {}
+        for bb in self:
+            sl = bb.instrs[0].parent
+            if sl not in content:
+                content[sl] = []
+                funcs.append(content[sl])
+            content[sl].append(bb)
+        return funcs
+
+    def new_block(self, like, instrs=None):
+        """Create a BB belonging to the same function as the BB 'like'. The BB
+        is not inserted in the CFG."""
+        from ir import EmptyStat
+        first = like.instrs[0]
+        if not instrs:
+            instrs = [EmptyStat(first.parent, symtab=first.symtab)]
+        for i in instrs:
+            i.parent = first.parent
+        return BasicBlock(None, instrs)
+
+    def new_jump_block(self, like, target):
+        """Create a BB which only contains an unconditional branch to 'target'"""
+        from ir import BranchStat
+        label = target.get_entry_label()
+        bb = self.new_block(like, [BranchStat(None, None, label, like.instrs[0].symtab)])
+        bb.target = label
+        bb.target_bb = target
+        return bb
+
+    def insert_block_before(self, target, preds):
+        """Insert a new empty BB just before 'target', and make the BBs in
+        'preds' reach the new BB instead of 'target'. The new BB falls through
+        to 'target'."""
+        bb = self.new_block(target)
+        i = self.index(target)
+        layout_pred = self[i - 1] if i > 0 else None
+        if layout_pred is not None and layout_pred.next is target and layout_pred not in preds:
+            # the fall-through edge must be kept: make it explicit
+            jump = self.new_jump_block(target, target)
+            layout_pred.next = jump
+            self.insert(i, jump)
+            i += 1
+        self.insert(i, bb)
+        bb.next = target
+        for p in preds:
+            p.redirect(target, bb)
+        self.invalidate(target.get_function())
+        return bb
+
+    def split_edge(self, src, dst):
+        """Insert a new empty BB on the edge from 'src' to 'dst'"""
+        if src.next is dst or src.target_bb is not dst:
+            return self.insert_block_before(dst, [src])
+        # a branch edge: if possible, place the new BB after an unconditional
+        # branch, so that no fall-through edge is disturbed
+        func = [f for f in self.functions() if dst in f][0]
+        for p in func:
+            if p.next is None and p.ends_with_branch() and p.instrs[-1].is_unconditional():
+                jump = self.new_jump_block(dst, dst)
+                self.insert(self.index(p) + 1, jump)
+                src.redirect(dst, jump)
+                self.invalidate(dst.get_function())
+                return jump
+        return self.insert_block_before(dst, [src])
+
+    def update_ir(self):
+        """Write the instructions of each BB back to the StatList they were
+        taken from, in CFG order. Must be called by any pass which changes the
+        instructions in the BBs, as the code generator walks the IR tree."""
+        stat_lists = []
+        content = {}
         for bb in self:
-            out.append(bb.liveness_iteration())
-        while sum(out) != False:
-            out = []
+            sl = bb.instrs[0].parent
+            if sl not in content:
+                stat_lists.append(sl)
+                content[sl] = []
+            content[sl] += bb.instrs
+        for sl in stat_lists:
+            for i in content[sl]:
+                i.parent = sl
+            sl.children = content[sl]
+
+    def liveness(self):
+        """Standard live variable analysis. If the calls have mod/ref summaries
+        (interprocedural is True) the global variables live at the exit of a
+        procedure are the ones live after its call sites; the analysis is then
+        repeated until these sets do not change. Otherwise all the global
+        variables are considered live at the exit of a procedure."""
+        exit_live = {} if self.interprocedural else None
+        while True:
+            boundary = {}
             for bb in self:
-                out.append(bb.liveness_iteration())
+                func = bb.get_function()
+                if not bb.succ() and func != 'global':
+                    live = func.get_global_symbols() if exit_live is None else exit_live.get(func.symbol, set())
+                    boundary[bb] = self.variables.mask(live)
+            self.solve_liveness(self, boundary)
+            if exit_live is None:
+                break
+            new = self.call_site_liveness()
+            if new == exit_live:
+                break
+            exit_live = new
+
+    def function_liveness(self, blocks):
+        """Recompute the liveness in the BBs of a single function, after a
+        change which does not affect the variables live at its exits (such as
+        the introduction of new temporaries)"""
+        self.solve_liveness(blocks, {bb: bb.live_out_mask for bb in blocks if not bb.succ()})
+
+    def solve_liveness(self, blocks, boundary):
+        """Liveness of the given BBs; 'boundary' contains the variables live
+        at the exit BBs"""
+        self.update_index()
+        for bb in blocks:
+            bb.compute_gen_kill(self.variables)
+        live_in, live_out = solve(blocks, {bb: bb.gen for bb in blocks}, {bb: bb.kill for bb in blocks},
+                                  lambda bb: self.succs[bb.number], lambda bb: self.preds[bb.number],
+                                  backward=True, boundary=boundary)
+        for bb in blocks:
+            bb.live_in_mask = live_in[bb]
+            bb.live_out_mask = live_out[bb]
+            bb.instr_live = None
+            for i in bb.instrs:
+                i.bb = bb
+
+    def call_site_liveness(self):
+        """Map each procedure to the global variables live after its calls"""
+        res = {}
         for bb in self:
-            bb.compute_instr_level_liveness()
+            for i in bb.instrs:
+                if getattr(i, 'returns', False):
+                    live = res.setdefault(i.target, set())
+                    live |= {var for var in i.live_out if var.alloct == 'global'}
+        return res
@@ -10,7 +10,11 @@ This feature can be used only by IR nodes that are contained in a Block, and
 is used for adding constant literals."""
 
 from datalayout import *
+from ifconversion import *
 from ir import *
+from muldiv import *
+from scheduler import schedule_code
+from support import get_node_list
 
 localconsti = 0
 
@@ -40,17 +44,60 @@ def symbol_codegen(self, regalloc):
 Symbol.codegen = symbol_codegen
 
 
+def flags_after(stat, flags):
+    """The flags after the code of 'stat', given the flags before it. The
+    flags are represented by the temporary whose value they test and the
+    condition codes for its truth and falsity, or None if unknown."""
+    if isinstance(stat, BinStat) and stat.op in CONDITION_CODES:
+        return stat.dest, CONDITION_CODES[stat.op]
+    if flags is None or not preserves_flags(stat, flags[0]):
+        return None
+    return flags
+
+
+def predicate_code(code, cond):
+    """Add the condition code 'cond' to all the instructions in 'code'"""
+    lines = []
+    for line in code.split('\n'):
+        if line.startswith('\t') and not line.startswith('\t@'):
+            mnemonic, sep, operands = line[1:].partition(' ')
+            line = '\t' + mnemonic + cond + sep + operands
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def predicated_codegen(stat, regalloc, flags):
+    """Code of a predicated statement; the condition is tested only if the
+    flags do not already reflect it. Returns the code and the new flags."""
+    cond, negcond, merge = stat.predicate
+    res = ''
+    if flags is None or flags[0] is not cond:
+        res += regalloc.gen_spill_load_if_necessary(cond)
+        rcond = regalloc.get_register_for_variable(cond)
+        res += '\ttst ' + rcond + ', ' + rcond + '\n'
+        flags = (cond, ('ne', 'eq'))
+    code = codegen_append(['', ''], stat.codegen(regalloc))
+    return [res + predicate_code(code[0], flags[1][1 if negcond else 0]), code[1]], flags
+
+
 def irnode_codegen(self, regalloc):
     res = ['\t' + comment("irnode " + repr(id(self)) + ' type ' + repr(type(self))), '']
+    flags = None
     if 'children' in dir(self) and len(self.children):
         for node in self.children:
             try:
                 try:
                     labl = node.get_label()
                     res[0] += labl.name + ':\n'
+                    flags = None
                 except Exception:
                     pass
-                res = codegen_append(res, node.codegen(regalloc))
+                if getattr(node, 'predicate', None) is not None:
+                    code, flags = predicated_codegen(node, regalloc, flags)
+                    res = codegen_append(res, code)
+                else:
+                    res = codegen_append(res, node.codegen(regalloc))
+                    flags = flags_after(node, flags)
             except Exception as e:
                 res[0] += "\t" + comment("node " + repr(id(node)) + " did not generate any code")
                 res[0] += "\t" + comment("exc: " + repr(e))
@@ -60,6 +107,25 @@ def irnode_codegen(self, regalloc):
 IRNode.codegen = irnode_codegen
 
 
+def function_frame(block, regalloc):
+    """Registers saved by the prologue of a function: the callee-saved
+    registers it uses, the frame pointer if it is needed, and the link
+    register unless the function is a leaf. Tail calls do not count, as
+    they return directly to the caller of the function."""
+    stats = [n for n in get_node_list(block.body) if not isinstance(n, StatList)]
+    temps = set()
+    for stat in stats:
+        temps |= remove_non_regs(stat.collect_uses() + stat.collect_kills())
+    calleesave = REGS_CALLEESAVE + ([REG_FP] if OMIT_FRAME_POINTER else [])
+    saved = sorted([reg for reg in regalloc.registers(temps) if reg in calleesave])
+    framesize = block.stackroom + regalloc.spill_room(block)
+    usefp = framesize > 0 and not OMIT_FRAME_POINTER
+    if usefp:
+        saved.append(REG_FP)
+    leaf = not any([is_call(stat) and not getattr(stat, 'tail', False) for stat in stats])
+    return saved, leaf, usefp, framesize
+
+
 def block_codegen(self, regalloc):
     res = [comment('block'), '']
     for sym in self.symtab:
@@ -69,21 +135,35 @@ def block_codegen(self, regalloc):
         res[0] += '\t.global __pl0_start\n'
         res[0] += "__pl0_start:\n"
 
-    res[0] += save_regs(REGS_CALLEESAVE + [REG_FP, REG_LR])
-    res[0] += '\tmov ' + get_register_string(REG_FP) + ', ' + get_register_string(REG_SP) + '\n'
-    stacksp = self.stackroom + regalloc.spill_room()
-    res[0] += '\tsub ' + get_register_string(REG_SP) + ', ' + get_register_string(REG_SP) + ', #' + repr(stacksp) + '\n'
-
-    regalloc.enter_function_body(self)
+    saved, leaf, usefp, stacksp = function_frame(self, regalloc)
+    res[0] += save_regs(saved if leaf else saved + [REG_LR])
+    if usefp:
+        res[0] += '\tmov ' + get_register_string(REG_FP) + ', ' + get_register_string(REG_SP) + '\n'
+    if stacksp > 0:
+        res[0] += '\tsub ' + get_register_string(REG_SP) + ', ' + get_register_string(REG_SP) + ', #' + repr(stacksp) + '\n'
+
+    teardown = ''
+    if usefp:
+        teardown += '\tmov ' + get_register_string(REG_SP) + ', ' + get_register_string(REG_FP) + '\n'
+    elif stacksp > 0:
+        teardown += '\tadd ' + get_register_string(REG_SP) + ', ' + get_register_string(REG_SP) + ', #' + repr(stacksp) + '\n'
+
+    # tail calls restore the link register and jump to the callee
+    regalloc.enter_function_body(self, stacksp, teardown + restore_regs(saved if leaf else saved + [REG_LR]))
     try:
         res = codegen_append(res, self.body.codegen(regalloc))
     except Exception:
         pass
 
-    res[0] += '\tmov ' + get_register_string(REG_SP) + ', ' + get_register_string(REG_FP) + '\n'
-    res[0] += restore_regs(REGS_CALLEESAVE + [REG_FP, REG_LR])
-    res[0] += '\tbx lr\n'
+    res[0] += teardown
+    if leaf:
+        res[0] += restore_regs(saved)
+        res[0] += '\tbx lr\n'
+    else:
+        # return by popping the saved link register into pc
+        res[0] += restore_regs(saved + [REG_PC])
 
+    res[0] = schedule_code(res[0], function_name(self))
     res[0] = res[0] + res[1]
     res[1] = ''
 
@@ -114,8 +194,94 @@ def fun_codegen(self, regalloc):
 FunctionDef.codegen = fun_codegen
 
 
+def multiply_by_constant_code(rd, ra, c):
+    """Code of rd <- ra * c, for the constants lowered by muldiv.py; the
+    intermediate results are kept in the scratch register if rd is ra"""
+    seq = multiply_sequence(c)
+    acc = get_register_string(REG_SCRATCH) if rd == ra else rd
+    res = ''
+    for n, (op, a, b, shift) in enumerate(seq):
+        dest = rd if n == len(seq) - 1 else acc
+        operands = [{'x': ra, 'acc': acc}.get(a, a)]
+        if b is not None:
+            operands.append({'x': ra, 'acc': acc}.get(b, b) + (', lsl #' + repr(shift) if shift else ''))
+        res += '\t' + op + ' ' + dest + ', ' + ', '.join(operands) + '\n'
+    return res
+
+
+def divide_by_constant_code(rd, ra, d):
+    """Code of rd <- ra / d, rounding towards zero. Returns the code and the
+    trail with the magic number."""
+    scratch = get_register_string(REG_SCRATCH)
+    n = abs(d)
+    trail = ''
+    if n == 1:
+        res = '\tmov ' + rd + ', ' + ra + '\n'
+    elif n & (n - 1) == 0:
+        # add n - 1 to the negative dividends before shifting
+        k = n.bit_length() - 1
+        if k == 1:
+            res = '\tadd ' + scratch + ', ' + ra + ', ' + ra + ', lsr #31\n'
+        else:
+            res = '\tasr ' + scratch + ', ' + ra + ', #31\n'
+            res += '\tadd ' + scratch + ', ' + ra + ', ' + scratch + ', lsr #' + repr(32 - k) + '\n'
+        res += '\tasr ' + rd + ', ' + scratch + ', #' + repr(k) + '\n'
+    else:
+        magic, shift = magic_number(n)
+        lab, trail = new_local_const(repr(magic - 2 ** 32 if magic >= 2 ** 31 else magic))
+        res = '\tldr ' + scratch + ', ' + lab + '\n'
+        # the high word of M * x, plus x if M >= 2**31: the operands are read
+        # before rd is written, so rd can be the register of the dividend
+        if magic >= 2 ** 31:
+            res += '\tsmmla ' + rd + ', ' + ra + ', ' + scratch + ', ' + ra + '\n'
+        else:
+            res += '\tsmmul ' + rd + ', ' + ra + ', ' + scratch + '\n'
+        if shift:
+            res += '\tasr ' + rd + ', ' + rd + ', #' + repr(shift) + '\n'
+        # the quotient is one less than the result when the dividend is negative
+        res += '\tadd ' + rd + ', ' + rd + ', ' + rd + ', lsr #31\n'
+    if d < 0:
+        res += '\trsb ' + rd + ', ' + rd + ', #0\n'
+    return [res, trail]
+
+
+def divide_codegen(self, regalloc, rd, ra, rb):
+    """Code of rd <- ra / rb, calling the division routine of the runtime"""
+    r0, r1 = get_register_string(0), get_register_string(1)
+    savedregs = regalloc.live_caller_save_regs(self)
+    if regalloc.vartoreg[self.dest] in savedregs:
+        savedregs.remove(regalloc.vartoreg[self.dest])
+    res = save_regs(savedregs)
+    if rb == r0 and ra == r1:
+        scratch = get_register_string(REG_SCRATCH)
+        res += '\tmov ' + scratch + ', ' + r0 + '\n'
+        res += '\tmov ' + r0 + ', ' + r1 + '\n'
+        res += '\tmov ' + r1 + ', ' + scratch + '\n'
+    elif rb == r0:
+        res += '\tmov ' + r1 + ', ' + r0 + '\n'
+        res += '\tmov ' + r0 + ', ' + ra + '\n'
+    else:
+        if ra != r0:
+            res += '\tmov ' + r0 + ', ' + ra + '\n'
+        if rb != r1:
+            res += '\tmov ' + r1 + ', ' + rb + '\n'
+    res += '\tbl __pl0_div\n'
+    if rd != r0:
+        res += '\tmov ' + rd + ', ' + r0 + '\n'
+    res += restore_regs(savedregs)
+    return res
+
+
 def binstat_codegen(self, regalloc):
     res = regalloc.gen_spill_load_if_necessary(self.srca)
+    if self.imm is not None:
+        ra = regalloc.get_register_for_variable(self.srca)
+        rd = regalloc.get_register_for_variable(self.dest)
+        if self.op == "times":
+            res += multiply_by_constant_code(rd, ra, self.imm)
+            return res + regalloc.gen_spill_store_if_necessary(self.dest)
+        code, trail = divide_by_constant_code(rd, ra, self.imm)
+        return [res + code + regalloc.gen_spill_store_if_necessary(self.dest), trail]
     res += regalloc.gen_spill_load_if_necessary(self.srcb)
     ra = regalloc.get_register_for_variable(self.srca)
     rb = regalloc.get_register_for_variable(self.srcb)
@@ -128,7 +294,9 @@ def binstat_codegen(self, regalloc):
     elif self.op == "times":
         res += '\tmul ' + rd + ', ' + param + '\n'
     elif self.op == "slash":
-        res += '\tdiv ' + rd + ', ' + param + '\n'
+        res += divide_codegen(self, regalloc, rd, ra, rb)
+    elif self.flags_only:
+        res += '\tcmp ' + param + '\n'
     elif self.op == "eql":
         res += '\tcmp ' + param + '\n'
         res += '\tmoveq ' + rd + ', #1\n'
@@ -164,10 +332,11 @@ BinStat.codegen = binstat_codegen
 def print_codegen(self, regalloc):
     res = regalloc.gen_spill_load_if_necessary(self.src)
     rp = regalloc.get_register_for_variable(self.src)
-    res += save_regs(REGS_CALLERSAVE)
+    savedregs = regalloc.live_caller_save_regs(self)
+    res += save_regs(savedregs)
     res += '\tmov ' + get_register_string(0) + ', ' + rp + '\n'
     res += '\tbl __pl0_print\n'
-    res += restore_regs(REGS_CALLERSAVE)
+    res += restore_regs(savedregs)
     return res
 
 
@@ -179,7 +348,7 @@ def read_codegen(self, regalloc):
 
     # punch a hole in the saved registers if one of them is the destination
     # of this "instruction"
-    savedregs = list(REGS_CALLERSAVE)
+    savedregs = regalloc.live_caller_save_regs(self)
     if regalloc.vartoreg[self.dest] in savedregs:
         savedregs.remove(regalloc.vartoreg[self.dest])
 
@@ -205,19 +374,22 @@ def branch_codegen(self, regalloc):
             res += '\ttst ' + rcond + ', ' + rcond + '\n'
             return res + '\t' + ('beq' if self.negcond else 'bne') + ' ' + targetl + '\n'
     else:
+        if self.tail:
+            return regalloc.epilogue + '\tb ' + targetl + '\n'
+        savedregs = regalloc.live_caller_save_regs(self)
         if self.cond is None:
-            res = save_regs(REGS_CALLERSAVE)
+            res = save_regs(savedregs)
             res += '\tbl ' + targetl + '\n'
-            res += restore_regs(REGS_CALLERSAVE)
+            res += restore_regs(savedregs)
             return res
         else:
             res = regalloc.gen_spill_load_if_necessary(self.cond)
             rcond = regalloc.get_register_for_variable(self.cond)
             res += '\ttst ' + rcond + ', ' + rcond + '\n'
             res += '\t' + ('bne' if self.negcond else 'beq') + ' ' + rcond + ', 1f\n'
-            res += save_regs(REGS_CALLERSAVE)
+            res += save_regs(savedregs)
             res += '\tbl ' + targetl + '\n'
-            res += restore_regs(REGS_CALLERSAVE)
+            res += restore_regs(savedregs)
             res += '1:'
             return res
     return comment('impossible!')
@@ -239,11 +411,11 @@ def ldptrto_codegen(self, regalloc):
     trail = ''
     ai = self.symbol.allocinfo
     if type(ai) is LocalSymbolLayout:
-        off = ai.fpreloff
+        base, off = regalloc.frame_base_offset(ai.fpreloff)
         if off > 0:
-            res = '\tadd ' + rd + ', ' + get_register_string(REG_FP) + ', #' + repr(off) + '\n'
+            res = '\tadd ' + rd + ', ' + base + ', #' + repr(off) + '\n'
         else:
-            res = '\tsub ' + rd + ', ' + get_register_string(REG_FP) + ', #' + repr(-off) + '\n'
+            res = '\tsub ' + rd + ', ' + base + ', #' + repr(-off) + '\n'
     else:
         lab, tmp = new_local_const(ai.symname)
         trail += tmp
@@ -263,7 +435,11 @@ def storestat_codegen(self, regalloc):
     else:
         ai = self.dest.allocinfo
         if type(ai) is LocalSymbolLayout:
-            dest = '[' + get_register_string(REG_FP) + ', #' + ai.symname + ']'
+            dest = regalloc.frame_operand(ai.fpreloff, ai.symname)
+        elif self.address:
+            # the address was loaded before the loop containing the access
+            res += regalloc.gen_spill_load_if_necessary(self.address)
+            dest = '[' + regalloc.get_register_for_variable(self.address) + ']'
         else:
             lab, tmp = new_local_const(ai.symname)
             trail += tmp
@@ -295,7 +471,11 @@ def loadstat_codegen(self, regalloc):
     else:
         ai = self.symbol.allocinfo
         if type(ai) is LocalSymbolLayout:
-            src = '[' + get_register_string(REG_FP) + ', #' + ai.symname + ']'
+            src = regalloc.frame_operand(ai.fpreloff, ai.symname)
+        elif self.address:
+            # the address was loaded before the loop containing the access
+            res += regalloc.gen_spill_load_if_necessary(self.address)
+            src = '[' + regalloc.get_register_for_variable(self.address) + ']'
         else:
             lab, tmp = new_local_const(ai.symname)
             trail += tmp
@@ -10,8 +10,14 @@ REG_SP = 13
 REG_LR = 14
 REG_PC = 15
 
-REGS_CALLEESAVE = [4, 5, 6, 7, 8, 9, 10]
-REGS_CALLERSAVE = [0, 1, 2, 3]
+# address the stack frame from sp instead of fp, so that r11 can be used by
+# the register allocator
+OMIT_FRAME_POINTER = True
+
+
+def allocatable_registers():
+    """Number of registers (r0 onwards) handed to the register allocator"""
+    return REG_FP + 1 if OMIT_FRAME_POINTER else REG_FP
 
 
 def get_register_string(regid):
@@ -19,6 +25,8 @@ def get_register_string(regid):
         return 'lr'
     if regid == REG_SP:
         return 'sp'
+    if regid == REG_PC:
+        return 'pc'
     return 'r' + repr(regid)
 
 
@@ -59,10 +67,39 @@ def codegen_append(vec, code):
 # class RegisterAllocation:
 
 
-def enter_function_body(self, block):
+def enter_function_body(self, block, framesize, epilogue):
+    """'epilogue' tears down the frame of the function and restores the
+    registers saved by its prologue, except for pc"""
     self.curfun = block
     self.spillvarloc = dict()
     self.spillvarloctop = -block.stackroom
+    self.spillframeoffseti = 0
+    self.framesize = framesize
+    self.epilogue = epilogue
+
+
+def frame_base_offset(self, fpreloff):
+    """Base register and offset of a location in the frame of the current
+    function, given its offset from the frame pointer"""
+    if OMIT_FRAME_POINTER:
+        return get_register_string(REG_SP), fpreloff + self.framesize
+    return get_register_string(REG_FP), fpreloff
+
+
+def frame_operand(self, fpreloff, symname=None):
+    base, off = self.frame_base_offset(fpreloff)
+    if symname is not None and not OMIT_FRAME_POINTER:
+        return '[' + base + ', #' + symname + ']'
+    return '[' + base + ', #' + repr(off) + ']'
+
+
+def live_caller_save_regs(self, stat):
+    """Caller-saved registers which hold temporaries live after a call"""
+    try:
+        live = remove_non_regs(stat.live_out)
+    except AttributeError:
+        return list(REGS_CALLERSAVE)
+    return sorted(self.registers(live) & set(REGS_CALLERSAVE))
 
 
 def gen_spill_load_if_necessary(self, var):
@@ -72,7 +109,7 @@ def gen_spill_load_if_necessary(self, var):
         return ''
     offs = self.spillvarloctop - self.vartospillframeoffset[var] - 4
     rd = self.get_register_for_variable(var)
-    res = '\tldr ' + rd + ', [' + get_register_string(REG_FP) + ', #' + repr(offs) + ']'
+    res = '\tldr ' + rd + ', ' + self.frame_operand(offs)
     res += '\t' + comment('<<- fill')
     return res
 
@@ -89,13 +126,16 @@ def gen_spill_store_if_necessary(self, var):
         return ''
     offs = self.spillvarloctop - self.vartospillframeoffset[var] - 4
     rd = self.get_register_for_variable(var)
-    res = '\tstr ' + rd + ', [' + get_register_string(REG_FP) + ', #' + repr(offs) + ']'
+    res = '\tstr ' + rd + ', ' + self.frame_operand(offs)
     res += '\t' + comment('<<- spill')
     self.dematerialize_spilled_var_if_necessary(var)
     return res
 
 
 RegisterAllocation.enter_function_body = enter_function_body
+RegisterAllocation.frame_base_offset = frame_base_offset
+RegisterAllocation.frame_operand = frame_operand
+RegisterAllocation.live_caller_save_regs = live_caller_save_regs
 RegisterAllocation.gen_spill_load_if_necessary = gen_spill_load_if_necessary
 RegisterAllocation.get_register_for_variable = get_register_for_variable
 RegisterAllocation.gen_spill_store_if_necessary = gen_spill_store_if_necessary
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""Generic solver for gen/kill dataflow problems over bit vectors.
+
+The facts are represented as Python ints, with one bit for each element of a
+Numbering (for example, one bit for each variable). The blocks are visited
+with a worklist, initially in reverse postorder for forward problems and in
+postorder for backward problems, so that acyclic regions converge in a
+single visit; only the neighbours of a block whose facts changed are
+visited again."""
+
+from collections import deque
+
+
+class Numbering(object):
+    """Dense numbering of a set of objects, which grows on demand. The set of
+    objects represented by a bit vector is recovered with decode()."""
+
+    def __init__(self):
+        self.items = []  # id -> object
+        self.ids = {}  # object -> id
+
+    def id(self, item):
+        if item not in self.ids:
+            self.ids[item] = len(self.items)
+            self.items.append(item)
+        return self.ids[item]
+
+    def mask(self, items):
+        ids = [self.id(item) for item in items]
+        if len(ids) < 64:
+            res = 0
+            for i in ids:
+                res |= 1 << i
+            return res
+        # building a large int one bit at a time takes quadratic time
+        data = bytearray(max(ids) // 8 + 1)
+        for i in ids:
+            data[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(data, 'little')
+
+    def decode(self, mask):
+        res = set()
+        data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+        for i, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                res.add(self.items[8 * i + low.bit_length() - 1])
+                byte ^= low
+        return res
+
+    def __len__(self):
+        return len(self.items)
+
+
+def reverse_postorder(blocks, succs):
+    """Depth-first reverse postorder of the blocks. The search starts from
+    each block not yet visited, in the order of 'blocks', so that the blocks
+    unreachable from the first one are numbered as well."""
+    order = []
+    visited = set()
+    for root in blocks:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(succs(root)))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in visited:
+                    visited.add(child)
+                    stack.append((child, iter(succs(child))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    order.reverse()
+    return order
+
+
+def solve(blocks, gen, kill, succs, preds, backward=False, boundary=None, union=True, top=0):
+    """Solve a gen/kill problem on the graph of 'blocks'; succs and preds are
+    functions which return the neighbours of a block, gen and kill map each
+    block to a bit vector.
+
+    The facts flowing into a block (after it, for a backward problem) are the
+    union (or the intersection, if 'union' is False) of the facts flowing out
+    of its predecessors (its successors, for a backward problem); the blocks
+    without any get the value in the 'boundary' dictionary, or 0. 'top' is
+    the initial value, which must be the universal set for intersections.
+
+    Returns the (in, out) dictionaries; for a backward problem, in[bb] is the
+    value before the block and out[bb] the value after it, as for forward
+    problems."""
+    boundary = boundary if boundary is not None else {}
+    if backward:
+        succs, preds = preds, succs
+    order = reverse_postorder(blocks, succs)
+    if backward:
+        order.reverse()
+    inflow = {bb: top for bb in order}
+    outflow = {bb: top for bb in order}
+    work = deque(order)
+    queued = set(order)
+    while work:
+        bb = work.popleft()
+        queued.remove(bb)
+        sources = [outflow[p] for p in preds(bb) if p in outflow]
+        if not sources:
+            facts = boundary.get(bb, 0)
+        elif union:
+            facts = 0
+            for s in sources:
+                facts |= s
+        else:
+            facts = sources[0]
+            for s in sources[1:]:
+                facts &= s
+        inflow[bb] = facts
+        new = gen[bb] | (facts & ~kill[bb])
+        if new != outflow[bb]:
+            outflow[bb] = new
+            for s in succs(bb):
+                if s in outflow and s not in queued:
+                    queued.add(s)
+                    work.append(s)
+    if backward:
+        return outflow, inflow
+    return inflow, outflow
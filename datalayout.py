@@ -49,6 +49,15 @@ def perform_data_layout_of_function(funcroot):
     funcroot.body.stackroom = -offs
 
 
+def allocate_stack_slot(block, var, prefix):
+    """Add a variable to the frame of a function whose data layout has already
+    been computed"""
+    bsize = var.stype.size // 8
+    block.stackroom += bsize
+    var.set_alloc_info(LocalSymbolLayout(prefix + var.name, -block.stackroom, bsize))
+    block.symtab.append(var)
+
+
 def perform_data_layout_of_program(root):
     prefix = "_g_"
     for var in root.symtab:
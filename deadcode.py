@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""Dead code and dead store elimination, driven by liveness analysis.
+
+An instruction without side effects is dead if the temporary it defines is
+not live after it. A store to a local variable is dead if the variable is not
+live after it: procedures cannot access the local variables of their callers,
+so only the code of the current function can read them. Stores to global
+variables are removed only when the calls carry mod/ref summaries; otherwise
+liveness does not know which globals the callees read. Variables whose
+address is taken are never considered, as liveness does not track the
+accesses made through pointers.
+
+Removing an instruction can make the instructions computing its operands
+dead, so the analysis is repeated until no more instructions are removed."""
+
+from ir import *
+
+
+def is_pure(i):
+    """True if the instruction only computes a value in a temporary"""
+    return isinstance(i, (LoadImmStat, LoadPtrToSym, BinStat, UnaryStat)) or \
+        (isinstance(i, LoadStat) and i.dest.alloct == 'reg')
+
+
+def is_dead(i, interprocedural, escaped):
+    if is_pure(i):
+        return i.dest not in i.live_out
+    if isinstance(i, StoreStat):
+        memory = ['auto', 'global'] if interprocedural else ['auto']
+        return i.dest.alloct in memory and i.dest not in i.live_out and i.dest not in escaped
+    return False
+
+
+def dead_code_elimination(cfg):
+    """Remove dead instructions and dead stores until a fixed point is
+    reached. Returns the number of instructions removed."""
+    removed = 0
+    stores = 0
+    escaped = set([i.symbol for bb in cfg for i in bb.instrs if isinstance(i, LoadPtrToSym)])
+    while True:
+        cfg.liveness()
+        found = 0
+        for bb in cfg:
+            dead = set([i for i in bb.instrs if is_dead(i, cfg.interprocedural, escaped)])
+            if dead:
+                stores += len([i for i in dead if isinstance(i, StoreStat)])
+                bb.remove_instrs(dead)
+                found += len(dead)
+        if not found:
+            break
+        removed += found
+    cfg.update_ir()
+    print('Dead code elimination: removed', removed - stores, 'instructions and', stores, 'stores')
+    return removed
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""Register allocation by graph coloring, using the iterated register
+coalescing algorithm (George and Appel). This is an alternative to the
+linear-scan allocator, and produces the same RegisterAllocation objects.
+
+The interference graph is built from the instruction-level liveness, so
+lifetime holes are taken into account. Copies between temporaries are
+coalesced when this cannot make the graph uncolorable (Briggs' or George's
+test), so that no code is generated for them. The temporaries which cannot
+be colored are rewritten like in the linear-scan allocator: they are moved
+to a stack slot, and each BB reloads them in a short temporary (or
+recomputes them, if they are constants or addresses). A temporary live
+across calls is spilled as well when only caller-saved registers are left
+for it, and saving one around the calls costs more than the spill code.
+The graph is then built and colored again, until no temporary other than
+these short ones is spilled; the ones left are filled and spilled at each
+use through the two registers reserved for this."""
+
+from heapq import heappush, heappop
+from regalloc import *
+
+
+def is_copy(i):
+    from ir import UnaryStat
+    return isinstance(i, UnaryStat) and i.op == 'plus' and i.src.alloct == 'reg' and i.dest.alloct == 'reg' and \
+        i.predicate is None
+
+
+class InterferenceGraph(object):
+    """Interference graph over dense temporary ids. Edges are stored in a bit
+    matrix (one int for each row), for constant time membership tests, and
+    in adjacency lists, for visiting the neighbours of a node."""
+
+    def __init__(self, n):
+        self.matrix = [0] * n
+        self.adj = [[] for i in range(n)]
+        self.degree = [0] * n
+
+    def interferes(self, u, v):
+        return self.matrix[u] & (1 << v) != 0
+
+    def add_edge(self, u, v):
+        if u != v and not self.interferes(u, v):
+            self.matrix[u] |= 1 << v
+            self.matrix[v] |= 1 << u
+            self.adj[u].append(v)
+            self.adj[v].append(u)
+            self.degree[u] += 1
+            self.degree[v] += 1
+
+    def edges(self):
+        return sum(self.degree) // 2
+
+
+class GraphColoringRegisterAllocator(SpillingRegisterAllocator):
+    """Produces the RegisterAllocation object of a function, given the list of
+    its BBs, by coloring the interference graph of its temporaries with
+    nregs - 2 colors (2 registers are reserved for spilled temporaries)."""
+
+    def __init__(self, cfg, blocks, nregs, freq):
+        super().__init__(cfg, blocks, nregs, freq)
+        self.k = nregs - 2
+
+    def temp_id(self, var):
+        if var not in self.ids:
+            self.ids[var] = len(self.temps)
+            self.temps.append(var)
+            self.cost.append(0)
+            self.calls.append(0)
+            self.splitcalls.append(0)
+            self.reloaded.append(False)
+            self.defs.append([])
+            self.length.append(0)
+        return self.ids[var]
+
+    def build(self):
+        self.temps = []  # id -> temporary
+        self.ids = {}  # temporary -> id
+        # weighted number of the stores and reloads of each temporary, if it
+        # is spilled: one store for each definition, and one reload in each
+        # BB which uses it before defining it
+        self.cost = []
+        self.calls = []  # weighted number of calls the temporary is live across
+        self.splitcalls = []  # the ones it would not be live across, if spilled
+        self.reloaded = []  # True if some BB uses the temporary before defining it
+        self.defs = []  # definitions of each temporary
+        self.length = []  # number of instructions the temporary is live at
+        self.moves = []  # (dest id, src id) of each copy
+        edges = []
+        for bb in self.blocks:
+            available = set()  # temporaries which would not be reloaded in the BB
+            usedlater = []  # temporaries used after each instruction of the BB
+            later = set()
+            for i in reversed(bb.instrs):
+                usedlater.append(later)
+                later = later | remove_non_regs(i.collect_uses())
+            for i, later in zip(bb.instrs, reversed(usedlater)):
+                defs = [self.temp_id(v) for v in remove_non_regs(i.collect_kills())]
+                for t in defs:
+                    self.defs[t].append(i)
+                uses = [self.temp_id(v) for v in remove_non_regs(i.collect_uses())]
+                live = set([self.temp_id(v) for v in remove_non_regs(i.live_out)])
+                for t in live | set(defs):
+                    self.length[t] += 1
+                for t in set(uses) - available:
+                    self.cost[t] += self.freq[bb]
+                    self.reloaded[t] = True
+                available |= set(uses)
+                for t in defs:
+                    self.cost[t] += self.freq[bb]
+                    if i.predicate is None:
+                        available.add(t)
+                    else:
+                        available.discard(t)
+                if is_copy(i):
+                    # the source and the destination of a copy hold the same
+                    # value, so they do not interfere because of it
+                    live -= set(uses)
+                    self.moves.append((defs[0], uses[0]))
+                if is_call(i):
+                    for t in live - set(defs):
+                        self.calls[t] += self.freq[bb]
+                        if t not in available or self.temps[t] not in later:
+                            self.splitcalls[t] += self.freq[bb]
+                edges += [(d, l) for d in defs for l in live]
+        self.graph = InterferenceGraph(len(self.temps))
+        for u, v in edges:
+            self.graph.add_edge(u, v)
+        self.remat = rematerializable({self.temps[t]: self.defs[t] for t in range(len(self.temps))})
+        # the temporaries created by spilling cannot be shortened any further,
+        # and neither can the ones which are never reloaded
+        self.unspillable = [var in self.reloads or not (self.reloaded[t] or var in self.remat)
+                            for t, var in enumerate(self.temps)]
+
+    def make_worklists(self):
+        n = len(self.temps)
+        self.alias = list(range(n))
+        self.removed = [False] * n  # on the select stack, or coalesced
+        self.movelist = [[] for i in range(n)]
+        for m, (d, s) in enumerate(self.moves):
+            self.movelist[d].append(m)
+            self.movelist[s].append(m)
+        self.worklistmoves = set([m for m, (d, s) in enumerate(self.moves) if d != s])
+        self.activemoves = set()
+        self.coalescedmoves = 0
+        self.simplify = []
+        self.freeze = set()
+        self.spill = set()
+        self.spillheap = []
+        self.stack = []
+        for t in range(n):
+            if self.graph.degree[t] >= self.k:
+                self.add_spill_candidate(t)
+            elif self.move_related(t):
+                self.freeze.add(t)
+            else:
+                self.simplify.append(t)
+
+    def add_spill_candidate(self, t):
+        self.spill.add(t)
+        heappush(self.spillheap, (self.spill_priority(t), t))
+
+    def spill_priority(self, t):
+        """Spill code per instruction the temporary is live at, like in the
+        linear-scan allocator: temporaries with long live ranges and few
+        uses are spilled first, and the uses in loops count more. The
+        temporaries which can be rematerialized need no store and no memory
+        access, and the ones created by spilling are spilled last."""
+        if self.unspillable[t]:
+            return float('inf')
+        prio = self.cost[t] / max(self.length[t], 1)
+        if self.temps[t] in self.remat:
+            return prio / 2
+        return prio
+
+    def adjacent(self, t):
+        return [u for u in self.graph.adj[t] if not self.removed[u]]
+
+    def node_moves(self, t):
+        return [m for m in self.movelist[t] if m in self.activemoves or m in self.worklistmoves]
+
+    def move_related(self, t):
+        return len(self.node_moves(t)) > 0
+
+    def get_alias(self, t):
+        while self.alias[t] != t:
+            t = self.alias[t]
+        return t
+
+    def decrement_degree(self, t):
+        self.graph.degree[t] -= 1
+        if self.graph.degree[t] == self.k - 1:
+            self.enable_moves([t] + self.adjacent(t))
+            self.spill.discard(t)
+            if self.move_related(t):
+                self.freeze.add(t)
+            else:
+                self.simplify.append(t)
+
+    def enable_moves(self, nodes):
+        for t in nodes:
+            for m in self.node_moves(t):
+                if m in self.activemoves:
+                    self.activemoves.remove(m)
+                    self.worklistmoves.add(m)
+
+    def do_simplify(self):
+        t = self.simplify.pop()
+        self.stack.append(t)
+        self.removed[t] = True
+        for u in self.adjacent(t):
+            self.decrement_degree(u)
+
+    def add_worklist(self, t):
+        if not self.move_related(t) and self.graph.degree[t] < self.k:
+            self.freeze.discard(t)
+            self.simplify.append(t)
+
+    def conservative(self, nodes):
+        """Briggs' test: coalescing is safe if the resulting node has less
+        than k neighbours of significant degree"""
+        return len([t for t in nodes if self.graph.degree[t] >= self.k]) < self.k
+
+    def george(self, u, v):
+        """George's test: coalescing v into u is safe if each neighbour of v
+        of significant degree already interferes with u"""
+        return all([self.graph.degree[t] < self.k or self.graph.interferes(t, u) for t in self.adjacent(v)])
+
+    def do_coalesce(self):
+        m = self.worklistmoves.pop()
+        u, v = [self.get_alias(t) for t in self.moves[m]]
+        if u == v:
+            self.coalescedmoves += 1
+            self.add_worklist(u)
+        elif self.graph.interferes(u, v):
+            self.add_worklist(u)
+            self.add_worklist(v)
+        elif self.george(u, v) or self.george(v, u) or self.conservative(set(self.adjacent(u)) | set(self.adjacent(v))):
+            if not self.george(u, v) and self.george(v, u):
+                u, v = v, u
+            self.coalescedmoves += 1
+            self.combine(u, v)
+            self.add_worklist(u)
+        else:
+            self.activemoves.add(m)
+
+    def combine(self, u, v):
+        if v in self.freeze:
+            self.freeze.remove(v)
+        else:
+            self.spill.discard(v)
+        self.removed[v] = True
+        self.alias[v] = u
+        self.movelist[u] = self.movelist[u] + self.movelist[v]
+        self.cost[u] += self.cost[v]
+        self.length[u] += self.length[v]
+        self.calls[u] += self.calls[v]
+        self.splitcalls[u] += self.splitcalls[v]
+        self.unspillable[u] = self.unspillable[u] and self.unspillable[v]
+        self.enable_moves([v])
+        for t in self.adjacent(v):
+            self.graph.add_edge(t, u)
+            self.decrement_degree(t)
+        if self.graph.degree[u] >= self.k and u in self.freeze:
+            self.freeze.remove(u)
+            self.add_spill_candidate(u)
+
+    def freeze_moves(self, u):
+        for m in self.node_moves(u):
+            x, y = [self.get_alias(t) for t in self.moves[m]]
+            v = x if y == self.get_alias(u) else y
+            self.activemoves.discard(m)
+            self.worklistmoves.discard(m)
+            if not self.move_related(v) and self.graph.degree[v] < self.k and v in self.freeze:
+                self.freeze.remove(v)
+                self.simplify.append(v)
+
+    def do_freeze(self):
+        u = self.freeze.pop()
+        self.simplify.append(u)
+        self.freeze_moves(u)
+
+    def select_spill(self):
+        # the priority of a candidate changes when another node is coalesced
+        # with it: a stale priority is pushed again if it is too low
+        while True:
+            prio, t = heappop(self.spillheap)
+            if t not in self.spill:
+                continue
+            if prio < self.spill_priority(t):
+                heappush(self.spillheap, (self.spill_priority(t), t))
+                continue
+            break
+        self.spill.remove(t)
+        self.simplify.append(t)
+        self.freeze_moves(t)
+
+    def assign_colors(self):
+        color = {}
+        spilled = []
+        while self.stack:
+            t = self.stack.pop()
+            okcolors = set(range(self.k))
+            for u in self.graph.adj[t]:
+                a = self.get_alias(u)
+                if a in color:
+                    okcolors.discard(color[a])
+            if not okcolors or (not okcolors - set(REGS_CALLERSAVE) and not self.unspillable[t] and
+                                2 * self.splitcalls[t] > self.cost[t]):
+                # no color, or only registers which would be pushed and
+                # popped around more calls than the spill code
+                spilled.append(t)
+                continue
+            # prefer the color of a copy partner, so that the copy vanishes
+            partners = [self.get_alias(x) for m in self.movelist[t] for x in self.moves[m]]
+            biased = okcolors & set([color[p] for p in partners if p in color])
+            color[t] = choose_register(biased if biased else okcolors, self.calls[t] > 0)
+        return color, spilled
+
+    def color(self):
+        """Color the graph of the current code of the function. Returns the
+        register of each temporary."""
+        self.build()
+        print('INTERFERENCE GRAPH OF', function_name(self.block) + ':', len(self.temps), 'temporaries,', self.graph.edges(), 'edges,',
+              len(self.moves), 'copies')
+        self.make_worklists()
+        while self.simplify or self.worklistmoves or self.freeze or self.spill:
+            if self.simplify:
+                self.do_simplify()
+            elif self.worklistmoves:
+                self.do_coalesce()
+            elif self.freeze:
+                self.do_freeze()
+            else:
+                self.select_spill()
+        color, spilled = self.assign_colors()
+        print('Graph coloring of', function_name(self.block) + ': coalesced', self.coalescedmoves, 'copies, spilled', len(spilled), 'nodes')
+
+        vartoreg = {}
+        for t, var in enumerate(self.temps):
+            a = self.get_alias(t)
+            vartoreg[var] = color[a] if a in color else SPILL_FLAG
+        return vartoreg
+
+    def __call__(self):
+        rounds = 0
+        while True:
+            vartoreg = self.color()
+            rounds += 1
+            spilled = set([var for var in vartoreg if vartoreg[var] == SPILL_FLAG])
+            if not spilled - self.reloads:
+                break
+            self.spill_to_stack(spilled - self.reloads)
+            self.cfg.function_liveness(self.blocks)
+
+        print('Graph coloring of', function_name(self.block) + ':', rounds, 'rounds,', self.stackslots, 'temporaries spilled to the stack,',
+              self.rematerialized, 'rematerialized,', len(spilled), 'filled at each use')
+        return RegisterAllocation(vartoreg, len(spilled), self.nregs, self.block)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""If-conversion. Short conditionals are replaced by predicated instructions,
+which ARM executes or skips depending on the flags, so that they no longer
+cost a (possibly mispredicted) branch.
+
+Two shapes of regions are converted: triangles, where a conditional branch
+skips a single BB, and diamonds, where it chooses between two BBs which then
+join again. The BBs of the arms must have no other predecessors, and must
+contain at most MAX_ARM_SIZE statements whose code neither sets the flags nor
+contains calls. Each statement of an arm is predicated on the condition of the
+branch (or on its negation, for the arm executed when the branch is not
+taken), and the arms are appended to the BB of the branch, which then
+proceeds to the join point.
+
+The code generator tests the condition once before the predicated
+statements; when the flags still hold the comparison which computed the
+condition, the statements use its condition code directly. If the
+predicated statements are the only users of the condition, the comparison
+then only sets the flags, and the condition is not computed at all."""
+
+from ir import *
+
+MAX_ARM_SIZE = 4  # statements in each arm of a converted region
+
+# condition codes of the comparisons, when they are true and when they are false
+CONDITION_CODES = {'eql': ('eq', 'ne'), 'neq': ('ne', 'eq'), 'lss': ('lt', 'ge'), 'leq': ('le', 'gt'),
+                   'gtr': ('gt', 'le'), 'geq': ('ge', 'lt')}
+
+
+def predicable(stat):
+    """True if the code of the statement can be executed conditionally: it
+    must neither set the flags nor contain calls"""
+    if isinstance(stat, BinStat):
+        return stat.op in ('plus', 'minus', 'times')
+    return isinstance(stat, (UnaryStat, LoadImmStat, LoadPtrToSym, LoadStat, StoreStat))
+
+
+def preserves_flags(stat, cond):
+    """True if the code of the statement leaves both the flags and the 'cond'
+    temporary unchanged"""
+    return (predicable(stat) or isinstance(stat, EmptyStat)) and cond not in stat.collect_kills()
+
+
+class IfConversion(object):
+    """If-conversion of the regions of a single function"""
+
+    def __init__(self, cfg, func, uses, stats):
+        self.cfg = cfg
+        self.func = func
+        self.uses = uses
+        self.stats = stats
+
+    def arm(self, bb, join, cond):
+        """The statements of a BB which can be predicated on 'cond' and which
+        then proceeds to 'join', or None"""
+        if bb is self.entry or len(self.preds[bb]) != 1 or bb.succ() != [join]:
+            return None
+        stats = bb.instrs
+        if bb.ends_with_branch():
+            if not stats[-1].is_unconditional():
+                return None
+            stats = stats[:-1]
+        stats = [i for i in stats if not isinstance(i, EmptyStat)]
+        if len(stats) > MAX_ARM_SIZE:
+            return None
+        for i in stats:
+            if not preserves_flags(i, cond) or i.predicate is not None:
+                return None
+        return stats
+
+    def region(self, head):
+        """The arms, as a list of (BB, statements, negcond), and the join point
+        of the region starting with the conditional branch of 'head'"""
+        if not head.ends_with_branch() or head.instrs[-1].is_unconditional():
+            return None, None
+        branch = head.instrs[-1]
+        taken, fall = head.target_bb, head.next
+        if fall is None or taken is fall:
+            return None, None
+        # the branch is taken when the condition is true, unless negcond
+        cond, negcond = branch.cond, branch.negcond
+        if len(fall.succ()) == 1 and fall.succ() == taken.succ():
+            join = fall.succ()[0]
+            then, other = self.arm(taken, join, cond), self.arm(fall, join, cond)
+            if then is not None and other is not None and join not in (head, taken, fall):
+                self.stats['diamonds'] += 1
+                return [(taken, then, negcond), (fall, other, not negcond)], join
+        then = self.arm(taken, fall, cond)
+        if then is not None and fall is not head:
+            self.stats['triangles'] += 1
+            return [(taken, then, negcond)], fall
+        other = self.arm(fall, taken, cond)
+        if other is not None and taken is not head:
+            self.stats['triangles'] += 1
+            return [(fall, other, not negcond)], taken
+        return None, None
+
+    @staticmethod
+    def redefinitions(stats):
+        """Temporaries which the statements of an arm define before using them"""
+        res = set()
+        used = set()
+        for i in stats:
+            used |= set(i.collect_uses())
+            res |= set([var for var in i.collect_kills() if var.alloct == 'reg' and var not in used])
+        return res
+
+    def merges(self, stat, stats, redefined):
+        """True if the destinations of a statement of an arm must keep their
+        old value when the statement is not executed; this is not needed for
+        the temporaries used only by the statements following it in the arm,
+        nor for the ones which the other arm of a diamond, executed instead,
+        redefines"""
+        following = stats[stats.index(stat) + 1:]
+        for var in stat.collect_kills():
+            if var in redefined:
+                continue
+            if var.alloct != 'reg' or not all([i in following for bb, i in self.uses.get(var, [])]):
+                return True
+        return False
+
+    def compare_to_flags(self, head, branch):
+        """Make the comparison computing the condition of the converted branch
+        only set the flags, if the flags still hold its result when the
+        predicated statements are executed, and they are its only users"""
+        cond = branch.cond
+        if [i for bb, i in self.uses.get(cond, [])] != [branch]:
+            return
+        for i in reversed(head.instrs):
+            if isinstance(i, BinStat) and i.dest is cond:
+                if i.op in CONDITION_CODES:
+                    i.flags_only = True
+                return
+            if not preserves_flags(i, cond):
+                return
+
+    def convert(self, head, arms, join):
+        branch = head.instrs[-1]
+        head.remove_instrs({branch})
+        # the first arm of a diamond is placed before the second one, whose
+        # statements must still merge with the values of the first arm
+        redefined = [self.redefinitions(arms[1][1]) if len(arms) == 2 else set(), set()]
+        for (bb, stats, negcond), other in zip(arms, redefined):
+            for i in stats:
+                i.label = None
+                i.predicate = (branch.cond, negcond, self.merges(i, stats, other))
+            if stats:
+                head.append_instrs(stats)
+            self.stats['predicated'] += len(stats)
+            self.cfg.remove(bb)
+        self.compare_to_flags(head, branch)
+        head.target = None
+        head.target_bb = None
+        head.next = None
+        pos = self.cfg.index(head)
+        if pos + 1 < len(self.cfg) and self.cfg[pos + 1] is join:
+            head.next = join
+        else:
+            label = join.get_entry_label()
+            head.append_instrs([BranchStat(None, None, label, branch.symtab)])
+            head.target = label
+            head.target_bb = join
+        self.cfg.invalidate(self.func)
+
+    def __call__(self):
+        blocks = self.cfg.function_blocks(self.func)
+        self.entry = blocks[0]
+        self.preds = self.cfg.predecessors()
+        removed = set()
+        # the arms of a converted region cannot be converted again, so the
+        # innermost conditionals are visited first
+        for head in reversed(blocks):
+            if head in removed:
+                continue
+            arms, join = self.region(head)
+            if arms is None:
+                continue
+            self.convert(head, arms, join)
+            for bb, stats, negcond in arms:
+                removed.add(bb)
+                if bb in self.preds[join]:
+                    self.preds[join].remove(bb)
+            if head not in self.preds[join]:
+                self.preds[join].append(head)
+
+
+def if_conversion(cfg):
+    """Convert the short conditionals of all the functions to predicated
+    code. Returns the statistics of the pass."""
+    stats = {'triangles': 0, 'diamonds': 0, 'predicated': 0}
+    uses = cfg.collect_uses()
+    for func in cfg.heads():
+        IfConversion(cfg, func, uses, stats)()
+    cfg.invalidate()
+    cfg.update_ir()
+    print('If-conversion:', stats['triangles'], 'triangles,', stats['diamonds'], 'diamonds,', stats['predicated'],
+          'predicated statements')
+    return stats
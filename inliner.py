@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""Procedure inlining. Works on the lowered and flattened IR tree, before
+data layout.
+
+PL/0 procedures have no parameters and no return value, so a call can be
+replaced by a copy of the body of the callee, where:
+ - temporaries and labels are renamed, so that they are unique;
+ - the local variables of the callee become variables of the caller's frame
+   (global variables when the caller is the main block).
+Procedures are visited from the leaves of the call graph, so that the bodies
+which get copied already have their own calls inlined. Recursive procedures
+are never inlined."""
+
+from ir import *
+from callgraph import *
+
+# procedures up to this size (in instructions) are always worth inlining
+INLINE_SIZE = 24
+# procedures called only once are inlined up to this size
+INLINE_ONCE_SIZE = 200
+# maximum growth of the program size, as a fraction of the original size
+GROWTH_BUDGET = 0.5
+
+
+def instructions(node):
+    """Low-level statements in a flattened subtree, in order"""
+    if isinstance(node, StatList):
+        return sum([instructions(c) for c in node.children], [])
+    return [node]
+
+
+def code_size(node):
+    return len([i for i in instructions(node) if not isinstance(i, EmptyStat)])
+
+
+class Inliner(object):
+    def __init__(self, root):
+        self.root = root
+        self.callgraph = CallGraph(root)
+        self.sizes = {proc: code_size(self.body(proc)) for proc in self.callgraph.calls}
+        self.budget = int(sum(self.sizes.values()) * GROWTH_BUDGET)
+        self.renamed = {}  # (caller, local variable of the callee) -> variable of the caller
+        self.inlined = 0
+
+    def body(self, proc):
+        return self.root.body if proc == 'global' else self.callgraph.procedures[proc].body.body
+
+    def call_sites(self, proc):
+        return [i for i in instructions(self.body(proc)) if isinstance(i, BranchStat) and i.returns]
+
+    def call_count(self, callee):
+        return sum([len([i for i in self.call_sites(p) if i.target is callee]) for p in self.callgraph.calls])
+
+    def bottom_up(self):
+        """Procedures ordered so that callees come before their callers"""
+        order = []
+
+        def visit(proc, path):
+            if proc in order or proc in path:
+                return
+            for callee in self.callgraph.callees(proc):
+                visit(callee, path + [proc])
+            order.append(proc)
+
+        visit('global', [])
+        return order
+
+    def should_inline(self, caller, callee):
+        if callee not in self.callgraph.procedures or callee == caller or self.callgraph.is_recursive(callee):
+            return False
+        size = self.sizes[callee]
+        if size > self.budget:
+            return False
+        return size <= INLINE_SIZE or (size <= INLINE_ONCE_SIZE and self.call_count(callee) == 1)
+
+    def caller_block(self, caller):
+        return self.root if caller == 'global' else self.callgraph.procedures[caller].body
+
+    def local_renaming(self, caller, callee):
+        """Map the local variables of the callee to variables of the caller"""
+        block = self.caller_block(caller)
+        alloct = 'global' if caller == 'global' else 'auto'
+        renaming = {}
+        for var in self.callgraph.procedures[callee].body.symtab:
+            if var.stype.size == 0:
+                continue
+            if (caller, var) not in self.renamed:
+                name = callee.name + '_' + var.name
+                while block.symtab.find(name):
+                    name += '_'
+                newvar = Symbol(name, var.stype, var.value, alloct)
+                block.symtab.append(newvar)
+                self.renamed[(caller, var)] = newvar
+            renaming[var] = self.renamed[(caller, var)]
+        return renaming
+
+    def copy_body(self, caller, callee):
+        body = rename_temporaries(self.body(callee).clone())
+        stats = instructions(body)
+        labels = {}
+        for stat in stats:
+            if stat.get_label():
+                labels[stat.get_label()] = TYPENAMES['label']()
+                stat.set_label(labels[stat.get_label()])
+        renaming = self.local_renaming(caller, callee)
+        for stat in stats:
+            stat.replace_uses(renaming)
+            if isinstance(stat, BranchStat) and not stat.returns and stat.target in labels:
+                stat.target = labels[stat.target]
+        return stats
+
+    def inline_call(self, caller, call):
+        stats = self.copy_body(caller, call.target)
+        if call.get_label():
+            entry = EmptyStat(symtab=call.symtab)
+            entry.set_label(call.get_label())
+            stats.insert(0, entry)
+        sl = call.parent
+        for stat in stats:
+            stat.parent = sl
+        pos = sl.children.index(call)
+        sl.children[pos:pos + 1] = stats
+        growth = self.sizes[call.target] - 1
+        self.sizes[caller] += growth
+        self.budget -= growth
+        self.inlined += 1
+
+    def __call__(self):
+        for caller in self.bottom_up():
+            for call in self.call_sites(caller):
+                if self.should_inline(caller, call.target):
+                    print('Inlining', call.target.name, 'into', caller if caller == 'global' else caller.name)
+                    self.inline_call(caller, call)
+        return self.inlined
+
+
+def inline_procedures(root):
+    """Inline the calls to small procedures, and remove the procedures which
+    are not called anymore"""
+    inlined = Inliner(root)()
+    print('Inlining: inlined', inlined, 'calls')
+    eliminate_dead_procedures(root)
+    return inlined
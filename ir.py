@@ -6,6 +6,8 @@ and/or duck typing. Includes lowering and flattening functions. Every node must
 have a lowering function or a code generation function (codegen functions are
 in a separate module though)."""
 
+from copy import deepcopy
+
 from codegenhelp import *
 
 # UTILITIES
@@ -20,6 +22,26 @@ def new_temporary(symtab, type):
     return temp
 
 
+def rename_temporaries(node):
+    """Give new names to the temporaries defined in a lowered subtree (usually
+    a copy of another one), updating their uses inside the subtree"""
+    stats = [node]
+    i = 0
+    while i < len(stats):
+        stats += stats[i].children if isinstance(stats[i], StatList) else []
+        i += 1
+    renaming = {}
+    for stat in stats:
+        for var in stat.collect_kills():
+            if var.alloct == 'reg' and var not in renaming:
+                renaming[var] = new_temporary(stat.symtab, var.stype)
+    for stat in stats:
+        stat.replace_uses(renaming)
+        if getattr(stat, 'dest', None) in renaming:
+            stat.dest = renaming[stat.dest]
+    return node
+
+
 # TYPES
 
 # NOTE: the type system is very simple, so that we don't need explicit cast
@@ -44,6 +66,9 @@ class Type:
         self.qual_list = qualifiers
         self.name = name if name else self.default_name()
 
+    def __deepcopy__(self, memo):
+        return self  # types are never copied along with the IR
+
     def default_name(self):
         n = ''
         if 'unsigned' in self.qual_list:
@@ -130,6 +155,9 @@ class Symbol:
     def set_alloc_info(self, allocinfo):
         self.allocinfo = allocinfo
 
+    def __deepcopy__(self, memo):
+        return self  # symbols are never copied along with the IR
+
     def __repr__(self):
         base = self.alloct + ' ' + self.stype.name + ' ' + self.name + \
                (self.value if type(self.value) == str else '')
@@ -156,6 +184,9 @@ class SymbolTable(list):
     def exclude(self, barred_types):
         return [symb for symb in self if symb.stype not in barred_types]
 
+    def __deepcopy__(self, memo):
+        return self
+
 
 # IRNODE
 
@@ -181,6 +212,8 @@ class IRNode:  # abstract
             pass
         try:
             hre = self.human_repr()
+            if getattr(self, 'predicate', None) is not None:
+                hre = ('if not ' if self.predicate[1] else 'if ') + repr(self.predicate[0]) + ': ' + hre
             return label + hre
         except Exception:
             pass
@@ -246,6 +279,11 @@ class IRNode:  # abstract
                 pass
         return False
 
+    def clone(self):
+        """Deep copy of the subtree rooted in this node. Symbols, symbol tables
+        and types are shared with the original; the copy has the same parent."""
+        return deepcopy(self, {id(self.parent): self.parent})
+
     def get_function(self):
         if not self.parent:
             return 'global'
@@ -409,6 +447,42 @@ class Stat(IRNode):  # abstract
     def collect_kills(self):
         return []
 
+    def replace_uses(self, renaming):
+        """Replace each temporary used by this statement with the one it is
+        mapped to in the 'renaming' dictionary"""
+        if self.predicate is not None:
+            cond, negcond, merge = self.predicate
+            self.predicate = (renaming.get(cond, cond), negcond, merge)
+
+    # BB of the statement in the last liveness analysis (see cfg.py)
+    bb = None
+
+    # (condition, negcond, merge) if the statement is executed only when the
+    # condition temporary is true (false if negcond is True); merge tells
+    # whether the old value of the destinations is needed when it is not
+    # executed. See ifconversion.py
+    predicate = None
+
+    def predicated_uses(self, uses):
+        """Add to the uses of a statement the ones due to its predicate: the
+        condition, and the destinations if their old value is needed"""
+        if self.predicate is None:
+            return uses
+        cond, negcond, merge = self.predicate
+        return uses + [cond] + (self.collect_kills() if merge else [])
+
+    @property
+    def live_in(self):
+        if self.bb is None:
+            raise AttributeError('no liveness information')
+        return self.bb.instr_liveness(self)[0]
+
+    @property
+    def live_out(self):
+        if self.bb is None:
+            raise AttributeError('no liveness information')
+        return self.bb.instr_liveness(self)[1]
+
 
 class CallStat(Stat):
     """Procedure call"""
@@ -466,14 +540,18 @@ class WhileStat(Stat):
         self.body.parent = self
 
     def lower(self):
-        entry_label = TYPENAMES['label']()
+        """The loop is rotated: the condition is tested once before entering
+        the loop (guard), and then at the bottom of the body, so that each
+        iteration executes a single conditional branch."""
+        body_label = TYPENAMES['label']()
         exit_label = TYPENAMES['label']()
         exit_stat = EmptyStat(self.parent, symtab=self.symtab)
         exit_stat.set_label(exit_label)
-        self.cond.set_label(entry_label)
-        branch = BranchStat(None, self.cond.destination(), exit_label, self.symtab, negcond=True)
-        loop = BranchStat(None, None, entry_label, self.symtab)
-        stat_list = StatList(self.parent, [self.cond, branch, self.body, loop, exit_stat], self.symtab)
+        guard = rename_temporaries(self.cond.clone())
+        branch = BranchStat(None, guard.destination(), exit_label, self.symtab, negcond=True)
+        self.body.set_label(body_label)
+        loop = BranchStat(None, self.cond.destination(), body_label, self.symtab)
+        stat_list = StatList(self.parent, [guard, branch, self.body, self.cond, loop, exit_stat], self.symtab)
         return self.parent.replace(self, stat_list)
 
 
@@ -570,6 +648,9 @@ class PrintCommand(Stat):  # low-level node
     def collect_uses(self):
         return [self.src]
 
+    def replace_uses(self, renaming):
+        self.src = renaming.get(self.src, self.src)
+
     def human_repr(self):
         return 'print ' + repr(self.src)
 
@@ -610,7 +691,9 @@ class BranchStat(Stat):  # low-level node
         """cond == None -> branch always taken.
         If negcond is True and Cond != None, the branch is taken when cond is false,
         otherwise the branch is taken when cond is true.
-        If returns is True, this is a branch-and-link instruction."""
+        If returns is True, this is a branch-and-link instruction; 'summary'
+        is then the mod/ref summary of the called procedure, if known, and
+        'tail' tells whether the call is in tail position."""
         super().__init__(parent, [], symtab)
         self.cond = cond
         self.negcond = negcond
@@ -618,12 +701,20 @@ class BranchStat(Stat):  # low-level node
             raise RuntimeError('condition not in register')
         self.target = target
         self.returns = returns
+        self.summary = None
+        self.tail = False
 
     def collect_uses(self):
         if not (self.cond is None):
             return [self.cond]
+        if self.returns and self.summary:
+            return list(self.summary.ref)
         return []
 
+    def replace_uses(self, renaming):
+        if not (self.cond is None):
+            self.cond = renaming.get(self.cond, self.cond)
+
     def is_unconditional(self):
         if self.cond is None:
             return True
@@ -631,7 +722,7 @@ class BranchStat(Stat):  # low-level node
 
     def human_repr(self):
         if self.returns:
-            h = 'call '
+            h = 'tail call ' if self.tail else 'call '
         else:
             h = 'branch '
         if not (self.cond is None):
@@ -662,7 +753,11 @@ class LoadPtrToSym(Stat):  # low-level node
             raise RuntimeError('dest not to register')
 
     def collect_uses(self):
-        return [self.symbol]
+        return self.predicated_uses([self.symbol])
+
+    def replace_uses(self, renaming):
+        super().replace_uses(renaming)
+        self.symbol = renaming.get(self.symbol, self.symbol)
 
     def collect_kills(self):
         return [self.dest]
@@ -688,11 +783,21 @@ class StoreStat(Stat):  # low-level node
             raise RuntimeError('store not from register')
         self.dest = dest
         self.killhint = killhint
+        self.address = None  # temporary holding the address of a global dest (see licm.py)
 
     def collect_uses(self):
         if self.dest.alloct == 'reg':
-            return [self.symbol, self.dest]
-        return [self.symbol]
+            return self.predicated_uses([self.symbol, self.dest])
+        if self.address:
+            return self.predicated_uses([self.symbol, self.address])
+        return self.predicated_uses([self.symbol])
+
+    def replace_uses(self, renaming):
+        super().replace_uses(renaming)
+        self.symbol = renaming.get(self.symbol, self.symbol)
+        self.dest = renaming.get(self.dest, self.dest)
+        if self.address:
+            self.address = renaming.get(self.address, self.address)
 
     def collect_kills(self):
         if self.dest.alloct == 'reg':
@@ -722,13 +827,24 @@ class LoadStat(Stat):  # low-level node
         self.symbol = symbol
         self.dest = dest
         self.usehint = usehint
+        self.address = None  # temporary holding the address of a global symbol (see licm.py)
         if self.dest.alloct != 'reg':
             raise RuntimeError('load not to register')
 
     def collect_uses(self):
         if self.usehint:
-            return [self.symbol, self.usehint]
-        return [self.symbol]
+            return self.predicated_uses([self.symbol, self.usehint])
+        if self.address:
+            return self.predicated_uses([self.symbol, self.address])
+        return self.predicated_uses([self.symbol])
+
+    def replace_uses(self, renaming):
+        super().replace_uses(renaming)
+        self.symbol = renaming.get(self.symbol, self.symbol)
+        if self.usehint:
+            self.usehint = renaming.get(self.usehint, self.usehint)
+        if self.address:
+            self.address = renaming.get(self.address, self.address)
 
     def collect_kills(self):
         return [self.dest]
@@ -752,7 +868,7 @@ class LoadImmStat(Stat):  # low-level node
             raise RuntimeError('load not to register')
 
     def collect_uses(self):
-        return []
+        return self.predicated_uses([])
 
     def collect_kills(self):
         return [self.dest]
@@ -771,6 +887,8 @@ class BinStat(Stat):  # low-level node
         self.op = op
         self.srca = srca  # symbol
         self.srcb = srcb  # symbol
+        self.flags_only = False  # comparison only setting the flags (see ifconversion.py)
+        self.imm = None  # constant value of srcb, which is then not used (see muldiv.py)
         if self.dest.alloct != 'reg':
             raise RuntimeError('binstat dest not to register')
         if self.srca.alloct != 'reg' or self.srcb.alloct != 'reg':
@@ -780,13 +898,21 @@ class BinStat(Stat):  # low-level node
         return [self.dest]
 
     def collect_uses(self):
-        return [self.srca, self.srcb]
+        if self.imm is not None:
+            return self.predicated_uses([self.srca])
+        return self.predicated_uses([self.srca, self.srcb])
+
+    def replace_uses(self, renaming):
+        super().replace_uses(renaming)
+        self.srca = renaming.get(self.srca, self.srca)
+        self.srcb = renaming.get(self.srcb, self.srcb)
 
     def destination(self):
         return self.dest
 
     def human_repr(self):
-        return repr(self.dest) + ' <- ' + repr(self.srca) + ' ' + self.op + ' ' + repr(self.srcb)
+        srcb = '#' + repr(self.imm) if self.imm is not None else repr(self.srcb)
+        return repr(self.dest) + ' <- ' + repr(self.srca) + ' ' + self.op + ' ' + srcb
 
 
 class UnaryStat(Stat):  # low-level node
@@ -804,7 +930,11 @@ class UnaryStat(Stat):  # low-level node
         return [self.dest]
 
     def collect_uses(self):
-        return [self.src]
+        return self.predicated_uses([self.src])
+
+    def replace_uses(self, renaming):
+        super().replace_uses(renaming)
+        self.src = renaming.get(self.src, self.src)
 
     def destination(self):
         return self.dest
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""Partial redundancy elimination, using the lazy code motion algorithm
+(Knoop, Ruething and Steffen; in the formulation by Drechsler and Stadel).
+
+Expressions are identified lexically: two instructions compute the same
+expression if they apply the same operator to the same temporaries (or load
+the same memory location). Every evaluation of an expression which takes part
+in the transformation writes to a single temporary, which is then used in
+place of the redundant evaluations.
+
+Since all the operands of an expression are usually loaded into fresh
+temporaries, the pass runs in rounds: the first round merges the loads of
+variables and constants, which makes the expressions using them lexically
+identical in the following round."""
+
+from functools import reduce
+
+from ir import *
+from modref import call_may_modify
+from valuenumbering import access_size
+
+MAX_ROUNDS = 8
+
+
+def expression_key(i):
+    """Lexical representation of the expression computed by an instruction,
+    or None if the instruction cannot be moved"""
+    if isinstance(i, LoadImmStat):
+        return 'imm', i.val
+    if isinstance(i, LoadPtrToSym):
+        return 'addr', i.symbol
+    if isinstance(i, LoadStat):
+        if i.symbol.alloct == 'reg':
+            return 'loadp', i.symbol, access_size(i.symbol)
+        return 'load', i.symbol
+    if isinstance(i, BinStat):
+        a, b = i.srca, i.srcb
+        if i.op in ['plus', 'times', 'eql', 'neq'] and b.name < a.name:
+            a, b = b, a
+        return 'bin', i.op, a, b
+    if isinstance(i, UnaryStat) and i.op != 'plus':
+        return 'un', i.op, i.src
+    return None
+
+
+def key_operands(key):
+    if key[0] in ['bin']:
+        return [key[2], key[3]]
+    if key[0] in ['un', 'loadp']:
+        return [key[2] if key[0] == 'un' else key[1]]
+    return []
+
+
+def materialize(key, dest, symtab):
+    """Create an instruction which evaluates the expression 'key' into 'dest'"""
+    if key[0] == 'imm':
+        return LoadImmStat(dest=dest, val=key[1], symtab=symtab)
+    if key[0] == 'addr':
+        return LoadPtrToSym(dest=dest, symbol=key[1], symtab=symtab)
+    if key[0] in ['load', 'loadp']:
+        return LoadStat(dest=dest, symbol=key[1], symtab=symtab)
+    if key[0] == 'bin':
+        return BinStat(dest=dest, op=key[1], srca=key[2], srcb=key[3], symtab=symtab)
+    return UnaryStat(dest=dest, op=key[1], src=key[2], symtab=symtab)
+
+
+class LazyCodeMotion(object):
+    """One round of lazy code motion on the BBs of a single function"""
+
+    def __init__(self, cfg, blocks):
+        self.cfg = cfg
+        self.blocks = blocks
+        self.exprs = []  # expression index -> key
+        self.index = {}  # key -> expression index
+        self.users = {}  # temporary -> mask of the expressions using it
+        self.symloads = {}  # memory symbol -> mask of the expressions loading it
+        self.ptrloads = 0  # mask of the expressions loading through a pointer
+        self.stats = {'deleted': 0, 'inserted': 0, 'copies': 0}
+
+    def number_expressions(self):
+        for bb in self.blocks:
+            for i in bb.instrs:
+                key = expression_key(i)
+                if key is None or key in self.index:
+                    continue
+                e = len(self.exprs)
+                self.index[key] = e
+                self.exprs.append(key)
+                for var in key_operands(key):
+                    self.users[var] = self.users.get(var, 0) | (1 << e)
+                if key[0] == 'load':
+                    self.symloads[key[1]] = self.symloads.get(key[1], 0) | (1 << e)
+                elif key[0] == 'loadp':
+                    self.ptrloads |= 1 << e
+        self.all = (1 << len(self.exprs)) - 1
+
+    def killed_by(self, i):
+        """Mask of the expressions whose value can be changed by an instruction"""
+        mask = 0
+        try:
+            kills = i.collect_kills()
+        except AttributeError:
+            kills = []
+        for var in kills:
+            mask |= self.users.get(var, 0)
+        if isinstance(i, StoreStat):
+            if i.dest.alloct == 'reg':
+                mask |= self.ptrloads
+            else:
+                mask |= self.symloads.get(i.dest, 0)
+        elif isinstance(i, BranchStat) and i.returns:
+            for sym, loads in self.symloads.items():
+                if call_may_modify(i, sym):
+                    mask |= loads
+            if call_may_modify(i, None):
+                mask |= self.ptrloads
+        return mask
+
+    def local_properties(self):
+        """Compute the upward exposed (UE), downward exposed (DE) and killed
+        expressions of each BB, and remember where they are evaluated."""
+        self.ue, self.de, self.kill = {}, {}, {}
+        self.ue_instr, self.de_instr = {}, {}
+        for bb in self.blocks:
+            ue, kill = 0, 0
+            ue_instr, de_instr = {}, {}
+            for i in bb.instrs:
+                key = expression_key(i)
+                if key is not None:
+                    e = self.index[key]
+                    if not (kill >> e) & 1 and e not in ue_instr:
+                        ue |= 1 << e
+                        ue_instr[e] = i
+                    de_instr[e] = i
+                k = self.killed_by(i)
+                kill |= k
+                for e in list(de_instr):
+                    if (k >> e) & 1:
+                        del de_instr[e]
+            self.ue[bb], self.kill[bb] = ue, kill
+            self.de[bb] = sum([1 << e for e in de_instr])
+            self.ue_instr[bb], self.de_instr[bb] = ue_instr, de_instr
+
+    def dataflow(self):
+        preds = {bb: [] for bb in self.blocks}
+        succs = {}
+        for bb in self.blocks:
+            succs[bb] = []
+            for s in bb.succ():
+                if s not in succs[bb]:
+                    succs[bb].append(s)
+                    preds[s].append(bb)
+        self.preds, self.succs = preds, succs
+
+        avout = {bb: self.all for bb in self.blocks}
+        antin = {bb: self.all for bb in self.blocks}
+        changed = True
+        while changed:
+            changed = False
+            for bb in self.blocks:
+                avin = reduce(lambda x, y: x & y, [avout[p] for p in preds[bb]], self.all) if preds[bb] else 0
+                new = self.de[bb] | (avin & ~self.kill[bb])
+                if new != avout[bb]:
+                    avout[bb] = new
+                    changed = True
+            for bb in reversed(self.blocks):
+                antout = reduce(lambda x, y: x & y, [antin[s] for s in succs[bb]], self.all) if succs[bb] else 0
+                new = self.ue[bb] | (antout & ~self.kill[bb])
+                if new != antin[bb]:
+                    antin[bb] = new
+                    changed = True
+        antout = {bb: reduce(lambda x, y: x & y, [antin[s] for s in succs[bb]], self.all) if succs[bb] else 0
+                  for bb in self.blocks}
+
+        earliest = {}
+        for i in self.blocks:
+            for j in succs[i]:
+                earliest[(i, j)] = antin[j] & ~avout[i] & (self.kill[i] | ~antout[i])
+
+        # the entry BB is reached from a virtual edge where nothing is available
+        laterin = {bb: antin[bb] if not preds[bb] else self.all for bb in self.blocks}
+        later = {}
+        changed = True
+        while changed:
+            changed = False
+            for j in self.blocks:
+                for i in preds[j]:
+                    later[(i, j)] = earliest[(i, j)] | (laterin[i] & ~self.ue[i])
+                if preds[j]:
+                    new = reduce(lambda x, y: x & y, [later[(i, j)] for i in preds[j]])
+                    if new != laterin[j]:
+                        laterin[j] = new
+                        changed = True
+
+        self.insert = {edge: later[edge] & ~laterin[edge[1]] for edge in later}
+        self.delete = {bb: self.ue[bb] & ~laterin[bb] for bb in self.blocks}
+
+    def select(self):
+        """Choose the expressions to transform in this round. An expression
+        cannot be transformed together with the expressions computing its
+        operands, as their destinations are going to be renamed."""
+        candidates = 0
+        for bb in self.blocks:
+            candidates |= self.delete[bb]
+        touched = set()
+        for bb in self.blocks:
+            for i in bb.instrs:
+                key = expression_key(i)
+                if key is not None and (candidates >> self.index[key]) & 1:
+                    touched.add(i.dest)
+        selected = 0
+        for e in range(len(self.exprs)):
+            if (candidates >> e) & 1 and not (set(key_operands(self.exprs[e])) & touched):
+                selected |= 1 << e
+        return selected
+
+    def transform(self, selected):
+        holders = {}
+        for e in range(len(self.exprs)):
+            if (selected >> e) & 1:
+                example = None
+                for bb in self.blocks:
+                    example = example or self.ue_instr[bb].get(e) or self.de_instr[bb].get(e)
+                holders[e] = new_temporary(example.symtab, example.dest.stype)
+
+        # first place the new evaluations, splitting critical edges if needed
+        for (i, j), mask in self.insert.items():
+            mask &= selected
+            if not mask:
+                continue
+            symtab = j.instrs[0].symtab
+            instrs = [materialize(self.exprs[e], holders[e], symtab) for e in holders if (mask >> e) & 1]
+            self.stats['inserted'] += len(instrs)
+            if len(self.preds[j]) == 1:
+                j.prepend_instrs(instrs)
+            elif len(self.succs[i]) == 1:
+                i.append_instrs(instrs)
+            else:
+                self.cfg.split_edge(i, j).append_instrs(instrs)
+
+        # then rewrite the original evaluations
+        uses = self.cfg.collect_uses()
+        for bb in self.blocks:
+            deleted = set()
+            for e, instr in self.ue_instr[bb].items():
+                if (self.delete[bb] & selected) >> e & 1:
+                    self.stats['copies'] += bb.forward_value(instr, instr.dest, holders[e], uses, True)
+                    deleted.add(instr)
+                    self.stats['deleted'] += 1
+            for e, instr in self.de_instr[bb].items():
+                if (selected >> e) & 1 and instr not in deleted:
+                    var = instr.dest
+                    instr.dest = holders[e]
+                    self.stats['copies'] += bb.forward_value(instr, var, holders[e], uses)
+
+    def __call__(self):
+        self.number_expressions()
+        self.local_properties()
+        self.dataflow()
+        selected = self.select()
+        if selected:
+            self.transform(selected)
+        return selected != 0
+
+
+def ensure_entry_without_predecessors(cfg, func):
+    """The entry BB of a function must not be the target of any edge, as new
+    evaluations are never inserted on the function entry"""
+    entry = func[0]
+    if any([entry in bb.succ() for bb in func]):
+        func.insert(0, cfg.insert_block_before(entry, []))
+
+
+def partial_redundancy_elimination(cfg):
+    """Run lazy code motion on each function until no more redundancies are
+    found. Returns the statistics of the transformation."""
+    stats = {'deleted': 0, 'inserted': 0, 'copies': 0}
+    for func in cfg.functions():
+        ensure_entry_without_predecessors(cfg, func)
+    for entry in [func[0] for func in cfg.functions()]:
+        for r in range(MAX_ROUNDS):
+            # the BBs of the function change when critical edges are split
+            func = [f for f in cfg.functions() if f[0] is entry][0]
+            lcm = LazyCodeMotion(cfg, func)
+            changed = lcm()
+            for k in stats:
+                stats[k] += lcm.stats[k]
+            if not changed:
+                break
+    cfg.update_ir()
+    print('Partial redundancy elimination: removed', stats['deleted'], 'evaluations, inserted',
+          stats['inserted'], 'evaluations and', stats['copies'], 'copies')
+    return stats
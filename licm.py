@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""Loop-invariant code motion. For each natural loop, from the innermost to
+the outermost one:
+ - scalar variables which cannot be modified behind the back of the loop are
+   promoted to a temporary, loaded in the preheader and stored back on the
+   loop exits;
+ - instructions whose operands do not change inside the loop are hoisted to
+   the preheader;
+ - the addresses of the remaining global variables accessed in the loop are
+   loaded once in the preheader, instead of from the literal pool at each
+   access.
+Hoisted instructions must not have side effects; loads are hoisted only if
+no store and no call in the loop can modify the memory they read."""
+
+from ir import *
+from loops import *
+from modref import call_may_access, call_may_modify
+from valuenumbering import count_definitions
+
+# maximum number of global variables whose address is kept in a register
+# for the whole duration of a loop
+MAX_ADDRESS_REGS = 4
+
+
+def is_scalar(sym):
+    return sym.alloct in ['auto', 'global'] and not isinstance(sym.stype, ArrayType) and sym.stype.size == 32
+
+
+class LoopInvariantCodeMotion(object):
+    def __init__(self, cfg, loop, preds, dom, stats):
+        self.cfg = cfg
+        self.loop = loop
+        self.preds = preds
+        self.dom = dom
+        self.stats = stats
+
+    def memory_effects(self):
+        self.calls = []
+        self.ptrstores = False
+        self.stored = set()
+        for i in self.loop.instrs():
+            if isinstance(i, BranchStat) and i.returns:
+                self.calls.append(i)
+            elif isinstance(i, StoreStat):
+                if i.dest.alloct == 'reg':
+                    self.ptrstores = True
+                else:
+                    self.stored.add(i.dest)
+
+    def may_be_modified(self, sym):
+        """True if the loop may change the value of a variable in memory"""
+        return sym in self.stored or any([call_may_modify(call, sym) for call in self.calls])
+
+    def accessed_vars(self):
+        """Memory variables accessed directly in the loop, in order of first
+        access"""
+        res = []
+        for i in self.loop.instrs():
+            if isinstance(i, LoadStat) and i.symbol.alloct != 'reg' and i.symbol not in res:
+                res.append(i.symbol)
+            elif isinstance(i, StoreStat) and i.dest.alloct != 'reg' and i.dest not in res:
+                res.append(i.dest)
+        return res
+
+    def insert_on_exits(self, make_instr):
+        for src, dst in self.loop.exit_edges():
+            instr = make_instr(dst.instrs[0].symtab)
+            if len(self.cfg.predecessors()[dst]) == 1:
+                dst.prepend_instrs([instr])
+            else:
+                self.cfg.split_edge(src, dst).append_instrs([instr])
+
+    def coalesce_copy(self, bb, copy, uses, defcount):
+        """Make the instruction computing the source of a copy write directly
+        to the copy destination, when the source is only used in the same BB
+        and the destination is not otherwise accessed in between"""
+        src = copy.src
+        srcuses = [i for ubb, i in uses.get(src, []) if i is not copy]
+        if defcount.get(src, 0) != 1 or any([ubb is not bb for ubb, i in uses.get(src, [])]):
+            return
+        pos = bb.instrs.index(copy)
+        last = max([pos] + [bb.instrs.index(i) for i in srcuses])
+        for j in range(pos + 1, last):
+            if copy.dest in bb.instrs[j].collect_kills():
+                return
+        for j in range(pos - 1, -1, -1):
+            i = bb.instrs[j]
+            if src in i.collect_kills():
+                if isinstance(i, (LoadStat, LoadImmStat, LoadPtrToSym, BinStat, UnaryStat, ReadCommand)):
+                    i.dest = copy.dest
+                    for u in srcuses:
+                        u.replace_uses({src: copy.dest})
+                    bb.remove_instrs({copy})
+                return
+            if copy.dest in i.collect_uses() or copy.dest in i.collect_kills():
+                return
+
+    def promote_scalars(self, preheader):
+        """Keep the scalar variables used by the loop in temporaries"""
+        promoted = [var for var in self.accessed_vars() if is_scalar(var) and
+                    not any([call_may_access(call, var) for call in self.calls])]
+        for var in promoted:
+            temp = new_temporary(preheader.instrs[0].symtab, var.stype)
+            preheader.append_instrs([LoadStat(dest=temp, symbol=var, symtab=preheader.instrs[0].symtab)])
+            if var in self.stored:
+                self.insert_on_exits(lambda symtab: StoreStat(dest=var, symbol=temp, symtab=symtab))
+            copies = []
+            for bb in self.loop.blocks:
+                for i in bb.instrs:
+                    if isinstance(i, StoreStat) and i.dest is var:
+                        copy = UnaryStat(i.parent, dest=temp, op='plus', src=i.symbol, symtab=i.symtab)
+                        if i.get_label():
+                            copy.set_label(i.get_label())
+                        bb.instrs[bb.instrs.index(i)] = copy
+                        copies.append((bb, copy))
+            uses = self.cfg.collect_uses()
+            for bb in self.loop.blocks:
+                for i in list(bb.instrs):
+                    if isinstance(i, LoadStat) and i.symbol is var:
+                        bb.forward_value(i, i.dest, temp, uses, True)
+            uses = self.cfg.collect_uses()
+            defcount = count_definitions(self.cfg)
+            for bb, copy in copies:
+                self.coalesce_copy(bb, copy, uses, defcount)
+        self.stats['promoted'] += len(promoted)
+        self.stored -= set(promoted)
+
+    def is_invariant(self, bb, i, loopdefs, defcount):
+        if not isinstance(i, (LoadImmStat, LoadPtrToSym, BinStat, UnaryStat, LoadStat)):
+            return False
+        if isinstance(i, BinStat) and i.op == 'slash':
+            return False  # division by zero must not be executed speculatively
+        if defcount.get(i.dest, 0) != 1:
+            return False
+        if isinstance(i, LoadStat):
+            if i.symbol.alloct == 'reg':
+                # the pointer may be invalid if the loop is not executed
+                if self.ptrstores or self.may_be_modified(None) or not dominates_exits(bb, self.loop, self.dom):
+                    return False
+            elif self.may_be_modified(i.symbol):
+                return False
+        return not (set(remove_non_regs(i.collect_uses())) & loopdefs)
+
+    def hoist_invariants(self, preheader):
+        defcount = count_definitions(self.cfg)
+        loopdefs = set()
+        for i in self.loop.instrs():
+            for var in i.collect_kills():
+                if var.alloct == 'reg':
+                    loopdefs.add(var)
+        changed = True
+        while changed:
+            changed = False
+            for bb in self.loop.blocks:
+                hoisted = []
+                for i in bb.instrs:
+                    if self.is_invariant(bb, i, loopdefs, defcount):
+                        hoisted.append(i)
+                        loopdefs.discard(i.dest)
+                if hoisted:
+                    bb.remove_instrs(set(hoisted))
+                    for i in hoisted:
+                        i.label = None
+                    preheader.append_instrs(hoisted)
+                    self.stats['hoisted'] += len(hoisted)
+                    changed = True
+
+    def hoist_global_addresses(self, preheader):
+        """Load the addresses of the global variables once. The accesses keep
+        the variable, so that the other passes still know the memory they
+        access, and only the code generator uses the address."""
+        count = {}
+        for i in self.loop.instrs():
+            if isinstance(i, LoadStat) and i.symbol.alloct == 'global':
+                count[i.symbol] = count.get(i.symbol, 0) + 1
+            elif isinstance(i, StoreStat) and i.dest.alloct == 'global':
+                count[i.dest] = count.get(i.dest, 0) + 1
+        chosen = sorted(count, key=lambda var: -count[var])[:MAX_ADDRESS_REGS]
+        symtab = preheader.instrs[0].symtab
+        for var in chosen:
+            ptr = new_temporary(symtab, PointerType(var.stype))
+            preheader.append_instrs([LoadPtrToSym(dest=ptr, symbol=var, symtab=symtab)])
+            for i in self.loop.instrs():
+                if isinstance(i, LoadStat) and i.symbol is var:
+                    i.address = ptr
+                elif isinstance(i, StoreStat) and i.dest is var:
+                    i.address = ptr
+        self.stats['addresses'] += len(chosen)
+
+    def __call__(self):
+        preheader = get_preheader(self.cfg, self.loop, self.preds)
+        self.memory_effects()
+        self.promote_scalars(preheader)
+        self.hoist_invariants(preheader)
+        self.hoist_global_addresses(preheader)
+
+
+def loop_invariant_code_motion(cfg):
+    """Run loop-invariant code motion on all the loops of the program"""
+    stats = {'hoisted': 0, 'promoted': 0, 'addresses': 0}
+    for entry in [func[0] for func in cfg.functions()]:
+        for loop, preds, dom in loops_innermost_first(cfg, entry):
+            LoopInvariantCodeMotion(cfg, loop, preds, dom, stats)()
+    cfg.update_ir()
+    print('Loop-invariant code motion: hoisted', stats['hoisted'], 'instructions, promoted', stats['promoted'],
+          'variables to registers,', stats['addresses'], 'global addresses kept in registers')
+    return stats
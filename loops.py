@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""Loop analysis. Computes the dominator tree of each function and finds
+its natural loops from the back edges (edges whose target dominates their
+source). The loops are arranged in a nesting forest."""
+
+from dataflow import reverse_postorder
+
+
+class Dominators(object):
+    """The set of the dominators of a BB, as a view of the dominator tree"""
+
+    def __init__(self, tree, bb):
+        self.tree = tree
+        self.bb = bb
+
+    def __contains__(self, other):
+        return self.tree.dominates(other, self.bb)
+
+    def __iter__(self):
+        bb = self.bb
+        while bb is not None:
+            yield bb
+            bb = self.tree.idom[bb]
+
+
+class DominatorTree(object):
+    """Dominator tree of the BBs of a function, computed with the algorithm
+    of Cooper, Harvey and Kennedy. blocks[0] must be the entry BB.
+
+    dom[bb] is the set of the dominators of bb. The BBs are numbered in
+    preorder and postorder of the tree, so that testing whether a BB
+    dominates another takes constant time. The BBs which cannot be reached
+    from the entry are only dominated by themselves."""
+
+    def __init__(self, blocks, preds):
+        entry = blocks[0]
+        allbbs = set(blocks)
+        order = reverse_postorder([entry], lambda bb: [s for s in bb.succ() if s in allbbs])
+        number = {bb: n for n, bb in enumerate(order)}
+        self.reachable = set(order)
+        self.idom = {bb: None for bb in blocks}
+        self.idom[entry] = entry
+
+        def intersect(a, b):
+            while a is not b:
+                while number[a] > number[b]:
+                    a = self.idom[a]
+                while number[b] > number[a]:
+                    b = self.idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for bb in order[1:]:
+                new = None
+                for p in preds[bb]:
+                    if p in number and self.idom[p] is not None:
+                        new = p if new is None else intersect(p, new)
+                if new is not self.idom[bb]:
+                    self.idom[bb] = new
+                    changed = True
+        self.idom[entry] = None
+
+        self.children = {bb: [] for bb in blocks}
+        for bb in order[1:]:
+            self.children[self.idom[bb]].append(bb)
+        self.pre = {}
+        self.post = {}
+        for root in blocks:
+            if root in self.pre or self.idom[root] is not None:
+                continue
+            self.pre[root] = len(self.pre)
+            stack = [(root, iter(self.children[root]))]
+            while stack:
+                bb, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    self.post[bb] = len(self.post)
+                    stack.pop()
+                else:
+                    self.pre[child] = len(self.pre)
+                    stack.append((child, iter(self.children[child])))
+        self.preds = preds
+        self.blocks = blocks
+
+    def dominates(self, a, b):
+        if a not in self.pre or b not in self.pre:
+            return False
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+    def __getitem__(self, bb):
+        return Dominators(self, bb)
+
+    def frontiers(self):
+        """Dominance frontier of each BB: the BBs where its dominance ends"""
+        df = {bb: set() for bb in self.blocks}
+        for bb in self.blocks:
+            reached = [p for p in self.preds[bb] if p in self.reachable]
+            if len(reached) < 2:
+                continue
+            for p in reached:
+                runner = p
+                while runner is not None and runner is not self.idom[bb]:
+                    df[runner].add(bb)
+                    runner = self.idom[runner]
+        return df
+
+
+def compute_dominators(blocks, preds):
+    """Dominators of the BBs of a function. blocks[0] must be the entry BB."""
+    return DominatorTree(blocks, preds)
+
+
+class Loop(object):
+    """A natural loop. 'blocks' are in CFG order; 'latches' are the sources of
+    the back edges to the header."""
+
+    def __init__(self, header, blocks, latches):
+        self.header = header
+        self.blocks = blocks
+        self.latches = latches
+        self.blockset = set(blocks)
+        # innermost enclosing loop, and loops directly nested in this one
+        self.parent = None
+        self.children = []
+
+    def depth(self):
+        """Nesting depth; 1 for the outermost loops"""
+        return 1 + (self.parent.depth() if self.parent else 0)
+
+    def __contains__(self, bb):
+        return bb in self.blockset
+
+    def exit_edges(self):
+        """List of the (source, destination) edges leaving the loop"""
+        edges = []
+        for bb in self.blocks:
+            for s in bb.succ():
+                if s not in self and (bb, s) not in edges:
+                    edges.append((bb, s))
+        return edges
+
+    def outside_preds(self, preds):
+        return [p for p in preds[self.header] if p not in self]
+
+    def instrs(self):
+        return [i for bb in self.blocks for i in bb.instrs]
+
+    def __repr__(self):
+        return 'Loop(header=' + repr(self.header.labels) + ', ' + repr(len(self.blocks)) + ' BBs)'
+
+
+def find_loops(blocks, preds, dom=None):
+    """Find the natural loops in the BBs of a function. Loops with the same
+    header are merged. The result is sorted from the innermost loops to the
+    outermost ones, and the parent and children of each loop describe how
+    they are nested."""
+    if dom is None:
+        dom = compute_dominators(blocks, preds)
+    bodies = {}
+    latches = {}
+    for bb in blocks:
+        for s in bb.succ():
+            if s in dom[bb]:  # back edge bb -> s
+                body = bodies.setdefault(s, {s})
+                latches.setdefault(s, [])
+                if bb not in latches[s]:
+                    latches[s].append(bb)
+                work = [bb]
+                while work:
+                    n = work.pop()
+                    if n not in body:
+                        body.add(n)
+                        work += preds[n]
+    loops = [Loop(h, [bb for bb in blocks if bb in bodies[h]], latches[h]) for h in bodies]
+    loops.sort(key=lambda l: len(l.blocks))
+    for i, loop in enumerate(loops):
+        for outer in loops[i + 1:]:
+            if loop.header in outer:
+                loop.parent = outer
+                outer.children.append(loop)
+                break
+    return loops
+
+
+class AnalysisCache(object):
+    """Dominator trees, dominance frontiers and loop nests of the functions of
+    a CFG, computed when first requested. The results for a function are kept
+    until the CFG reports a change in its BBs or edges (CFG.invalidate); the
+    instructions inside the BBs do not matter."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.results = {}  # (function, analysis) -> result
+        self.computed = 0
+        self.reused = 0
+
+    def get(self, func, name, compute):
+        key = (func, name)
+        if key in self.results:
+            self.reused += 1
+        else:
+            self.results[key] = compute()
+            self.computed += 1
+        return self.results[key]
+
+    def dominators(self, func):
+        return self.get(func, 'dominators',
+                        lambda: DominatorTree(self.cfg.function_blocks(func), self.cfg.predecessors()))
+
+    def frontiers(self, func):
+        return self.get(func, 'frontiers', lambda: self.dominators(func).frontiers())
+
+    def loops(self, func):
+        """Loops of the function, from the innermost to the outermost one"""
+        return self.get(func, 'loops', lambda: find_loops(self.cfg.function_blocks(func), self.cfg.predecessors(),
+                                                          self.dominators(func)))
+
+    def invalidate(self, func=None):
+        """Forget the results for 'func', or for all the functions if None"""
+        self.results = {key: res for key, res in self.results.items() if func is not None and key[0] is not func}
+
+
+def get_preheader(cfg, loop, preds):
+    """Return the BB which precedes the loop header on every path entering
+    the loop, inserting a new one if necessary"""
+    outside = loop.outside_preds(preds)
+    if len(outside) == 1 and outside[0].succ() in [[loop.header], [loop.header, loop.header]]:
+        return outside[0]
+    return cfg.insert_block_before(loop.header, outside)
+
+
+def loops_innermost_first(cfg, entry):
+    """Iterate over the loops of the function starting at 'entry', from the
+    innermost to the outermost one. Yields (loop, preds, dom) tuples; the
+    analysis is repeated after each loop is visited if the transformations
+    changed the BBs of the function."""
+    func = entry.get_function()
+    done = []
+    while True:
+        preds = cfg.predecessors()
+        dom = cfg.analyses.dominators(func)
+        loops = [l for l in cfg.analyses.loops(func) if l.header not in done]
+        if not loops:
+            return
+        done.append(loops[0].header)
+        yield loops[0], preds, dom
+
+
+def dominates_exits(bb, loop, dom):
+    """True if 'bb' is executed at each iteration that leaves the loop"""
+    return all([bb in dom[src] for src, dst in loop.exit_edges()])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Loop unrolling. Works on the IR tree before lowering, on the counted
+loops of the form
+
+    v := start;
+    while v <relop> bound do begin
+        ...
+        v := v + step
+    end
+
+where start, bound and step are constants and v is not assigned anywhere
+else in the loop. The trip count of such loops is known at compile time:
+small loops are fully unrolled, while larger ones are partially unrolled by
+UNROLL_FACTOR, with the leftover iterations executed before the loop."""
+
+from ir import *
+from support import get_node_list
+
+# maximum size (in IR nodes) of a fully unrolled loop
+FULL_UNROLL_SIZE = 80
+# maximum size (in IR nodes) of the body of a partially unrolled loop
+PARTIAL_UNROLL_SIZE = 120
+UNROLL_FACTOR = 4
+
+RELATIONAL_OPS = {'eql': lambda a, b: a == b, 'neq': lambda a, b: a != b, 'lss': lambda a, b: a < b,
+                  'leq': lambda a, b: a <= b, 'gtr': lambda a, b: a > b, 'geq': lambda a, b: a >= b}
+MIRRORED_OPS = {'lss': 'gtr', 'leq': 'geq', 'gtr': 'lss', 'geq': 'leq', 'eql': 'eql', 'neq': 'neq'}
+
+
+def is_var(node, var):
+    return isinstance(node, Var) and node.symbol is var
+
+
+def is_const(node):
+    return isinstance(node, Const) and node.symbol is None
+
+
+def statements(node):
+    return node.children if isinstance(node, StatList) else [node]
+
+
+def ceil_div(a, b):
+    return -(-a // b)
+
+
+def trip_count(start, op, bound, step):
+    """Number of iterations of a counted loop, or None if it cannot be
+    computed (or if the loop does not terminate)"""
+    test = RELATIONAL_OPS[op]
+    if not test(start, bound):
+        return 0
+    if op == 'lss' and step > 0:
+        n = ceil_div(bound - start, step)
+    elif op == 'leq' and step > 0:
+        n = ceil_div(bound + 1 - start, step)
+    elif op == 'gtr' and step < 0:
+        n = ceil_div(start - bound, -step)
+    elif op == 'geq' and step < 0:
+        n = ceil_div(start - bound + 1, -step)
+    elif op == 'neq' and step != 0 and (bound - start) % step == 0 and (bound - start) // step > 0:
+        n = (bound - start) // step
+    elif op == 'eql' and step != 0:
+        n = 1
+    else:
+        return None
+    if not -2 ** 31 <= start + n * step < 2 ** 31:
+        return None  # the induction variable would overflow
+    return n
+
+
+class CountedLoop(object):
+    """A while loop whose trip count is known at compile time"""
+
+    def __init__(self, loop, var, start, op, bound, step, trips):
+        self.loop = loop
+        self.var = var
+        self.start = start
+        self.op = op
+        self.bound = bound
+        self.step = step
+        self.trips = trips
+
+    def __repr__(self):
+        return 'CountedLoop(' + self.var.name + ' from ' + repr(self.start) + ' ' + self.op + ' ' + \
+               repr(self.bound) + ' step ' + repr(self.step) + ': ' + repr(self.trips) + ' trips)'
+
+
+def analyze_loop(loop):
+    """Return the CountedLoop describing a WhileStat, or None if its trip count
+    cannot be computed"""
+    parent = loop.parent
+    if not isinstance(parent, StatList) or loop not in parent.children:
+        return None
+    pos = parent.children.index(loop)
+    init = parent.children[pos - 1] if pos > 0 else None
+    if not isinstance(init, AssignStat) or init.offset is not None or not is_const(init.expr):
+        return None
+    var = init.symbol
+    if isinstance(var.stype, ArrayType) or var.stype.size != 32:
+        return None
+
+    cond = loop.cond
+    if not isinstance(cond, BinExpr) or cond.children[0] not in RELATIONAL_OPS:
+        return None
+    op, a, b = cond.children
+    if is_var(a, var) and is_const(b):
+        bound = b.value
+    elif is_const(a) and is_var(b, var):
+        op, bound = MIRRORED_OPS[op], a.value
+    else:
+        return None
+
+    inc = statements(loop.body)[-1]
+    if not isinstance(inc, AssignStat) or inc.symbol is not var or inc.offset is not None:
+        return None
+    expr = inc.expr
+    if not isinstance(expr, BinExpr) or expr.children[0] not in ['plus', 'minus']:
+        return None
+    if is_var(expr.children[1], var) and is_const(expr.children[2]):
+        step = expr.children[2].value
+    elif expr.children[0] == 'plus' and is_const(expr.children[1]) and is_var(expr.children[2], var):
+        step = expr.children[1].value
+    else:
+        return None
+    if expr.children[0] == 'minus':
+        step = -step
+
+    for node in get_node_list(loop.body):
+        if isinstance(node, CallStat):
+            return None  # the procedure may modify the induction variable
+        if isinstance(node, AssignStat) and node.symbol is var and node is not inc:
+            return None
+
+    trips = trip_count(init.expr.value, op, bound, step)
+    if trips is None:
+        return None
+    return CountedLoop(loop, var, init.expr.value, op, bound, step, trips)
+
+
+def copies(body, count):
+    return [body.clone() for i in range(count)]
+
+
+def unroll_loop(counted, factor, stats):
+    loop = counted.loop
+    size = len(get_node_list(loop.body))
+    if counted.trips * size <= FULL_UNROLL_SIZE:
+        loop.parent.replace(loop, StatList(children=copies(loop.body, counted.trips), symtab=loop.symtab))
+        stats['full'] += 1
+        return
+    factor = min(factor, PARTIAL_UNROLL_SIZE // size)
+    if factor < 2 or counted.trips < 2 * factor:
+        return
+    # the leftover iterations are executed before the loop, so that the loop
+    # runs for a multiple of 'factor' iterations and its test can be skipped
+    # after each copy of the body but the last
+    prologue = copies(loop.body, counted.trips % factor)
+    loop.body = StatList(loop, copies(loop.body, factor), loop.symtab)
+    parent = loop.parent
+    parent.replace(loop, StatList(children=prologue + [loop], symtab=loop.symtab))
+    stats['partial'] += 1
+
+
+def unroll_loops(root, factor=UNROLL_FACTOR):
+    """Unroll the counted loops in the IR tree, from the innermost ones"""
+    stats = {'full': 0, 'partial': 0}
+    loops = [node for node in get_node_list(root) if isinstance(node, WhileStat)]
+    for loop in loops:
+        counted = analyze_loop(loop)
+        print('Trip count analysis:', id(loop), counted)
+        if counted is not None:
+            unroll_loop(counted, factor, stats)
+    print('Loop unrolling: fully unrolled', stats['full'], 'loops, partially unrolled', stats['partial'], 'loops')
+    return stats
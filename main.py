@@ -6,12 +6,29 @@ import lexer
 import parser
 from support import *
 from datalayout import *
+from callgraph import *
+from loopunrolling import *
+from inliner import *
+from tailcalls import *
 from cfg import *
+from modref import *
+from valuenumbering import *
+from lazycodemotion import *
+from licm import *
+from strengthreduction import *
+from deadcode import *
+from muldiv import *
+from blocklayout import *
+from ifconversion import *
 from regalloc import *
+from graphcoloring import *
 from codegen import *
 
 
-def compile_program(text):
+REGISTER_ALLOCATORS = {'linearscan': LinearScanRegisterAllocator, 'coloring': GraphColoringRegisterAllocator}
+
+
+def compile_program(text, allocator='linearscan'):
     lex = lexer.Lexer(text)
     pars = parser.Parser(lex)
     res = pars.program()
@@ -25,6 +42,9 @@ def compile_program(text):
         print(type(n), id(n), '->', type(n.parent), id(n.parent))
     print('\nTotal nodes in IR:', len(node_list), '\n')
 
+    eliminate_dead_procedures(res)
+    unroll_loops(res)
+
     res.navigate(lowering)
 
     node_list = get_node_list(res)
@@ -40,18 +60,32 @@ def compile_program(text):
 
     print_dotty(res, "log.dot")
 
+    inline_procedures(res)
+    tail_call_optimization(res)
+
     print("\n\nDATALAYOUT\n\n")
     perform_data_layout(res)
     print('\n', res, '\n')
 
     cfg = CFG(res)
+
+    print("\n\nOPTIMIZATIONS\n\n")
+    compute_mod_ref(cfg)
+    local_value_numbering(cfg)
+    loop_invariant_code_motion(cfg)
+    strength_reduction(cfg)
+    partial_redundancy_elimination(cfg)
+    dead_code_elimination(cfg)
+    lower_constant_muldiv(cfg)
+    if_conversion(cfg)
+    block_layout(cfg)
+
     cfg.liveness()
     cfg.print_liveness()
     cfg.print_cfg_to_dot("cfg.dot")
 
     print("\n\nREGALLOC\n\n")
-    ra = LinearScanRegisterAllocator(cfg, 11)
-    reg_alloc = ra()
+    reg_alloc = allocate_registers(cfg, allocatable_registers(), REGISTER_ALLOCATORS[allocator])
     print(reg_alloc)
 
     print("\n\nCODEGEN\n\n")
@@ -66,13 +100,17 @@ def driver_main():
     test_program=__test_program
     import sys
     print(sys.argv)
-    if len(sys.argv) >= 2:
-        with open(sys.argv[1], 'r') as inf :
+    # --regalloc=<name> selects the register allocator
+    opts = [a.split('=', 1) for a in sys.argv[1:] if a.startswith('--')]
+    args = [sys.argv[0]] + [a for a in sys.argv[1:] if not a.startswith('--')]
+    allocator = dict(opts).get('--regalloc', 'linearscan')
+    if len(args) >= 2:
+        with open(args[1], 'r') as inf :
             test_program = inf.read()
-    code = compile_program(test_program)
+    code = compile_program(test_program, allocator)
 
-    if len(sys.argv) > 2:
-        with open(sys.argv[-1], 'w') as outf :
+    if len(args) > 2:
+        with open(args[-1], 'w') as outf :
             outf.write(code)
 
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""Interprocedural mod/ref analysis. For each procedure, computes the set of
+global variables it may read (ref) and write (mod), including the accesses
+made by the procedures it calls. Taking the address of a global variable
+counts as both reading and writing it, as the variable can then be accessed
+through pointers.
+
+The summaries are attached to the call instructions (BranchStat.summary), so
+that liveness analysis and the optimizations which move memory accesses
+across calls only need to assume the effects the callee may actually have."""
+
+from ir import *
+
+
+class ModRefSummary(object):
+    def __init__(self):
+        self.mod = set()
+        self.ref = set()
+
+    def update(self, other):
+        """Add the effects of 'other' to this summary. Returns True iff
+        something changed."""
+        size = len(self.mod) + len(self.ref)
+        self.mod |= other.mod
+        self.ref |= other.ref
+        return size != len(self.mod) + len(self.ref)
+
+    def may_modify(self, sym):
+        """'sym' is None for memory accessed through a pointer with an unknown
+        base"""
+        if sym is None:
+            return len(self.mod) > 0
+        return sym in self.mod
+
+    def may_access(self, sym):
+        return self.may_modify(sym) or sym in self.ref
+
+    def __repr__(self):
+        return 'mod=' + repr(sorted([s.name for s in self.mod])) + ' ref=' + repr(sorted([s.name for s in self.ref]))
+
+
+def call_may_modify(call, sym):
+    """True if the procedure called by 'call' may write the memory of 'sym'"""
+    if call.summary is None:
+        return sym is None or sym.alloct == 'global'
+    return call.summary.may_modify(sym)
+
+
+def call_may_access(call, sym):
+    """True if the procedure called by 'call' may read or write 'sym'"""
+    if call.summary is None:
+        return sym is None or sym.alloct == 'global'
+    return call.summary.may_access(sym)
+
+
+def local_summary(blocks):
+    """Effects of the instructions of a procedure, and the procedures it calls"""
+    summary = ModRefSummary()
+    callees = []
+    for bb in blocks:
+        for i in bb.instrs:
+            if isinstance(i, BranchStat) and i.returns:
+                callees.append(i.target)
+            elif isinstance(i, LoadStat) and i.symbol.alloct == 'global':
+                summary.ref.add(i.symbol)
+            elif isinstance(i, StoreStat) and i.dest.alloct == 'global':
+                summary.mod.add(i.dest)
+            elif isinstance(i, LoadPtrToSym) and i.symbol.alloct == 'global':
+                summary.mod.add(i.symbol)
+                summary.ref.add(i.symbol)
+    return summary, callees
+
+
+def compute_mod_ref(cfg):
+    """Compute the mod/ref summaries of all the procedures in the CFG and
+    attach them to the call instructions. Returns a dictionary which maps
+    each procedure symbol ('global' for the main block) to its summary."""
+    summaries = {}
+    callees = {}
+    for func in cfg.functions():
+        proc = func[0].get_function()
+        proc = proc if proc == 'global' else proc.symbol
+        summaries[proc], callees[proc] = local_summary(func)
+    # propagate the effects from the callees to the callers; recursive
+    # procedures require more than one iteration
+    changed = True
+    while changed:
+        changed = False
+        for proc in summaries:
+            for callee in callees[proc]:
+                if callee in summaries and summaries[proc].update(summaries[callee]):
+                    changed = True
+    for bb in cfg:
+        for i in bb.instrs:
+            if isinstance(i, BranchStat) and i.returns and i.target in summaries:
+                i.summary = summaries[i.target]
+    cfg.interprocedural = True
+    for proc, summary in summaries.items():
+        print('Mod/ref summary of', proc if proc == 'global' else proc.name + ':', summary)
+    return summaries
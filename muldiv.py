@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""Lowering of the multiplications and divisions by constants.
+
+ARMv6 has no division instruction, and its multiplier takes several cycles
+to produce a result. The multiplications and the divisions whose divisor
+(or either operand, for multiplications) is a temporary defined only by a
+LoadImmStat are marked with the value of the constant, which is then no
+longer used by them; the code generator emits instead:
+ - for multiplications, a sequence of shifts, additions and subtractions
+   following the canonical signed digit representation of the constant,
+   when it is at most MAX_MULTIPLY_SEQUENCE instructions long;
+ - for divisions by powers of two, an arithmetic shift of the dividend,
+   biased when it is negative so that the quotient rounds towards zero;
+ - for the other divisions, a multiplication by a magic number, of which
+   smmul (or smmla) computes the high word (Granlund and Montgomery; see
+   also Hacker's Delight, chapter 10).
+The divisions by other divisors call __pl0_div in the runtime."""
+
+from ir import *
+from strengthreduction import find_constants
+
+MAX_MULTIPLY_SEQUENCE = 3  # instructions, the latency of mul
+
+
+def csd_digits(n):
+    """The non-zero digits of the canonical signed digit representation of
+    n > 0, as a list of (sign, shift), from the least significant"""
+    res = []
+    shift = 0
+    while n:
+        if n & 1:
+            sign = 2 - (n & 3)  # +1 if n = 1 (mod 4), -1 if n = 3 (mod 4)
+            res.append((sign, shift))
+            n -= sign
+        n >>= 1
+        shift += 1
+    return res
+
+
+def multiply_sequence(c):
+    """The instructions computing c * x without multiplications, or None if
+    more than MAX_MULTIPLY_SEQUENCE are needed. Each instruction is a tuple
+    (mnemonic, first operand, second operand, left shift of the second
+    operand), where the operands are 'x', the result of the previous
+    instruction ('acc') or an immediate."""
+    if c == 0:
+        return [('mov', '#0', None, 0)]
+    n = abs(c)
+    zeros = (n & -n).bit_length() - 1
+    digits = [(sign if c > 0 else -sign, shift) for sign, shift in csd_digits(n >> zeros)]
+    res = []
+    # whether the result of the sequence so far is the opposite of the sum
+    # of the digits
+    negated = digits[0][0] < 0
+    if len(digits) > 1:
+        (s0, k0), (s1, k1) = digits[:2]
+        negated = s0 == s1 and s0 < 0
+        if s0 == s1:
+            res.append(('add', 'x', 'x', k1))
+        else:
+            res.append(('rsb' if s0 < 0 else 'sub', 'x', 'x', k1))
+        for sign, shift in digits[2:]:
+            res.append(('add' if (sign < 0) == negated else 'sub', 'acc', 'x', shift))
+    src = 'acc' if res else 'x'
+    if zeros:
+        res.append(('lsl', src, '#' + repr(zeros), 0))
+        src = 'acc'
+    if negated:
+        res.append(('rsb', src, '#0', 0))
+    elif not res:
+        res.append(('mov', 'x', None, 0))
+    if len(res) > MAX_MULTIPLY_SEQUENCE:
+        return None
+    return res
+
+
+def magic_number(d):
+    """The magic number M and the shift s for the signed division by d >= 2:
+    the quotient of x is the high word of M * x (plus x, if M >= 2**31)
+    shifted right by s, plus one if x is negative"""
+    two31 = 2 ** 31
+    anc = two31 - 1 - two31 % d
+    p = 31
+    q1, r1 = divmod(two31, anc)
+    q2, r2 = divmod(two31, d)
+    while True:
+        p += 1
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= d:
+            q2, r2 = q2 + 1, r2 - d
+        delta = d - r2
+        if not (q1 < delta or (q1 == delta and r1 == 0)):
+            break
+    return (q2 + 1) % 2 ** 32, p - 32
+
+
+def divides_by_constant(d):
+    """True if the division by d can be lowered: d is not 0, and its absolute
+    value fits in a signed word"""
+    return d != 0 and -2 ** 31 < d < 2 ** 31
+
+
+def lower_constant_muldiv(cfg):
+    """Mark the multiplications and divisions by constants of the whole
+    program, and remove the loads of the constants which are no longer used.
+    Returns the statistics of the pass."""
+    consts = find_constants(cfg)
+    stats = {'multiplications': 0, 'divisions': 0, 'removed': 0}
+    for bb in cfg:
+        for i in bb.instrs:
+            if not isinstance(i, BinStat) or i.imm is not None:
+                continue
+            if i.op == 'times' and i.srca in consts and i.srcb not in consts:
+                i.srca, i.srcb = i.srcb, i.srca
+            if i.srcb not in consts:
+                continue
+            val = consts[i.srcb]
+            if i.op == 'times' and multiply_sequence(val) is not None:
+                i.imm = val
+                stats['multiplications'] += 1
+            elif i.op == 'slash' and divides_by_constant(val):
+                i.imm = val
+                stats['divisions'] += 1
+    uses = cfg.collect_uses()
+    for bb in cfg:
+        dead = set([i for i in bb.instrs if isinstance(i, LoadImmStat) and i.dest in consts and i.dest not in uses])
+        if dead:
+            bb.remove_instrs(dead)
+            stats['removed'] += len(dead)
+    cfg.update_ir()
+    print('Constant multiplications and divisions: lowered', stats['multiplications'], 'multiplications,',
+          stats['divisions'], 'divisions, removed', stats['removed'], 'constants')
+    return stats
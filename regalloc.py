@@ -2,25 +2,69 @@
 
 """Register allocation pass, using the linear-scan algorithm.
 Assumes that all temporaries can be allocated to any register (because of this,
-it does not work with non integer types)."""
+it does not work with non integer types).
+
+Each function, and the main block, is allocated on its own: temporaries never
+outlive the function which defines them, so the allocation of a function does
+not depend on the others."""
 
 from cfg import *
+from datalayout import allocate_stack_slot
 
 # the register of all spilled temporaries is set to SPILL_FLAG
 SPILL_FLAG = 999
 
+# rounds of allocation in which the spilled temporaries are moved to the
+# stack, before they are spilled around each use
+SPILL_ROUNDS = 2
+
+# estimated number of iterations of a loop, for weighting the spill costs
+LOOP_WEIGHT = 10
+
+
+def block_frequencies(cfg, profile=None):
+    """Estimated execution frequency of each BB: the counts in 'profile'
+    (a dictionary BB -> count) if available, otherwise LOOP_WEIGHT raised to
+    the loop nesting depth of the BB"""
+    if profile is not None:
+        return {bb: profile.get(bb, 0) for bb in cfg}
+    freq = {bb: 1 for bb in cfg}
+    for func in cfg.heads():
+        # from the outermost loops, so that the frequency of each BB is set
+        # last by the innermost loop containing it
+        for loop in reversed(cfg.analyses.loops(func)):
+            for bb in loop.blocks:
+                freq[bb] = LOOP_WEIGHT ** loop.depth()
+    return freq
+
+# registers preserved across calls, and registers clobbered by them
+REGS_CALLEESAVE = [4, 5, 6, 7, 8, 9, 10]
+REGS_CALLERSAVE = [0, 1, 2, 3]
+
+
+def choose_register(freeregs, crosscall):
+    """Temporaries live across calls preferably go in callee-saved registers,
+    which are not saved at each call site; the others in caller-saved
+    registers, which are not saved by the prologue."""
+    preferred = [reg for reg in freeregs if (reg in REGS_CALLERSAVE) != crosscall]
+    return min(preferred) if preferred else min(freeregs)
+
 
 class RegisterAllocation(object):
     """Object that contains the information about where each temporary is
     allocated.
 
+    The spilled temporaries of each function are kept in the frame of that
+    function; 'spills' maps the Block of each function to their number.
+
     Spill handling is done by reserving 2 machine registers to be filled
     as late as possible, and spilled again as soon as possible. This class is
     responsible for filling these registers."""
 
-    def __init__(self, vartoreg, numspill, nregs):
+    def __init__(self, vartoreg, numspill, nregs, block=None):
         self.vartoreg = vartoreg
         self.numspill = numspill
+        self.spills = {block: numspill} if block is not None else {}
         self.nregs = nregs
         self.vartospillframeoffset = dict()
         self.spillregi = 0
@@ -29,9 +73,24 @@ class RegisterAllocation(object):
     def update(self, otherra):
         self.vartoreg.update(otherra.vartoreg)
         self.numspill += otherra.numspill
-
-    def spill_room(self):
-        return self.numspill * 4
+        for block, numspill in otherra.spills.items():
+            self.spills[block] = self.spills.get(block, 0) + numspill
+
+    def spill_room(self, block):
+        return self.spills.get(block, 0) * 4
+
+    def registers(self, temps):
+        """Machine registers that may hold the given temporaries. Spilled
+        temporaries can be filled in either of the spill-reserved registers."""
+        res = set()
+        for var in temps:
+            if var not in self.vartoreg:
+                continue
+            if self.vartoreg[var] == SPILL_FLAG or self.vartoreg[var] >= self.nregs - 2:
+                res |= set([self.nregs - 2, self.nregs - 1])
+            else:
+                res.add(self.vartoreg[var])
+        return res
 
     def dematerialize_spilled_var_if_necessary(self, var):
         """Resets the register used for a spill variable when we know that instance
@@ -72,102 +131,330 @@ class RegisterAllocation(object):
         return 'vartoreg = ' + repr(self.vartoreg)
 
 
-class LinearScanRegisterAllocator(object):
-    """The register allocator. Produces RegisterAllocation objects from a control
-    flow graph."""
+def enclosing_block(instr):
+    node = instr.parent
+    while type(node).__name__ != 'Block':
+        node = node.parent
+    return node
+
 
-    def __init__(self, cfg, nregs):
+def function_name(block):
+    return block.parent.symbol.name if block.parent else 'global'
+
+
+def rematerializable(defs):
+    """The temporaries which can be recomputed by a copy of their only
+    definition, which does not depend on other temporaries, given the list of
+    the definitions of each temporary"""
+    from ir import LoadImmStat, LoadPtrToSym
+    return {var: d[0] for var, d in defs.items()
+            if len(d) == 1 and isinstance(d[0], (LoadImmStat, LoadPtrToSym)) and d[0].predicate is None}
+
+
+class SpillingRegisterAllocator(object):
+    """Base of the register allocators of a single function, given the list
+    of its BBs in the control flow graph and the estimated execution
+    frequency of each BB. Rewrites the code of the temporaries which were
+    spilled, so that the allocation can be repeated."""
+
+    def __init__(self, cfg, blocks, nregs, freq):
         self.cfg = cfg
+        self.blocks = blocks
+        self.block = enclosing_block(blocks[0].instrs[0])
         self.nregs = nregs
-
-        # liveness of a variable on entry to each instruction
-        # in order of start point
-        self.varliveness = []  # {var=var, liveness=[indexes]}
-        # list of all variables
-        self.allvars = []
+        self.freq = freq
+        self.stackslots = 0
+        self.rematerialized = 0
+        # temporaries created by spill_to_stack
+        self.reloads = set()
+        self.names = None  # names in the symbol table of the function
+        self.remat = {}  # rematerializable temporary -> its definition
+
+    def stack_slot(self, var):
+        from ir import Symbol, TYPENAMES
+        prefix = '_l_' + self.block.parent.symbol.name + '_' if self.block.parent else '_g_'
+        if self.names is None:
+            self.names = set([sym.name for sym in self.block.symtab])
+        name = 'spill_' + var.name
+        while name in self.names:
+            name += '_'
+        self.names.add(name)
+        # slots are as large as the registers, whatever the type of the value
+        slot = Symbol(name, TYPENAMES['int'], alloct='auto')
+        allocate_stack_slot(self.block, slot, prefix)
+        self.stackslots += 1
+        return slot
+
+    def spill_to_stack(self, spilled):
+        """Second-chance spilling. Each temporary in 'spilled' is moved to a
+        stack slot: its value is stored after each definition, and reloaded
+        in a new temporary only once in each BB, for all the uses in the BB.
+        The new temporaries have short intervals, so they usually get a
+        register in the next round of allocation.
+        Rematerializable temporaries are not stored: their definition is
+        removed, and copied in place of each reload."""
+        from ir import LoadStat, StoreStat, EmptyStat, new_temporary
+        slots = {}
+        remat = {var: self.remat[var] for var in spilled if var in self.remat}
+        self.rematerialized += len(remat)
+        for bb in self.blocks:
+            current = {}  # spilled temporary -> temporary holding its value
+            instrs = []
+            for i in bb.instrs:
+                if i in remat.values():
+                    if i.get_label():
+                        instrs.append(EmptyStat(i.parent, symtab=i.symtab))
+                        instrs[-1].set_label(i.get_label())
+                    continue
+                renaming = {}
+                for var in remove_non_regs(i.collect_uses()):
+                    if var not in spilled:
+                        continue
+                    if var not in current:
+                        current[var] = new_temporary(i.symtab, var.stype)
+                        self.reloads.add(current[var])
+                        if var in remat:
+                            load = remat[var].clone()
+                            load.label = None
+                            load.dest = current[var]
+                        else:
+                            if var not in slots:
+                                slots[var] = self.stack_slot(var)
+                            load = LoadStat(i.parent, current[var], slots[var], symtab=i.symtab)
+                        if i.get_label():
+                            load.set_label(i.get_label())
+                            i.label = None
+                        instrs.append(load)
+                    renaming[var] = current[var]
+                i.replace_uses(renaming)
+                instrs.append(i)
+                try:
+                    kill = remove_non_regs(i.collect_kills())
+                except AttributeError:
+                    kill = set()
+                for var in kill:
+                    if var not in spilled:
+                        continue
+                    if var not in slots:
+                        slots[var] = self.stack_slot(var)
+                    current[var] = new_temporary(i.symtab, var.stype)
+                    self.reloads.add(current[var])
+                    i.dest = current[var]
+                    instrs.append(StoreStat(i.parent, slots[var], current[var], symtab=i.symtab))
+                    if i.predicate is not None:
+                        # the value is stored only if it is computed, and the
+                        # following uses reload it
+                        cond, negcond, merge = i.predicate
+                        i.predicate = (cond, negcond, False)
+                        instrs[-1].predicate = (cond, negcond, True)
+                        del current[var]
+            bb.instrs = instrs
+        self.cfg.update_ir()
+
+
+class LinearScanRegisterAllocator(SpillingRegisterAllocator):
+    """The register allocator. Produces the RegisterAllocation object of a
+    function, given the list of its BBs in the control flow graph and the
+    estimated execution frequency of each BB.
+
+    Temporaries are numbered with dense integer ids, in order of appearance.
+    The liveness interval of each temporary is a list of ranges over the
+    flattened function, with holes where the temporary is not live: each
+    instruction has a use point (2 * index) and a definition point
+    (2 * index + 1), and two temporaries can share a register if they do
+    not occupy the same point. Each register keeps the list of intervals
+    assigned to it, so that an interval can be placed in the holes of
+    another one.
+
+    When no register is free, the intervals with the lowest spill cost are
+    spilled; uses are weighted by the estimated execution frequency of their
+    BB. Spilled temporaries get a second chance: they are moved to a stack
+    slot, stored after each definition and reloaded in a new temporary by
+    the first use in each BB, and the allocation is repeated. Constants and
+    addresses are recomputed instead of reloaded. The temporaries which are
+    still spilled after SPILL_ROUNDS rounds are filled and spilled at each
+    use through the registers reserved for this."""
+
+    def __init__(self, cfg, blocks, nregs, freq):
+        super().__init__(cfg, blocks, nregs, freq)
         self.vartoreg = {}
 
     def compute_liveness_intervals(self):
-        """computes liveness intervals for the whole program. Note that the CFG
-        is flattened: this is the reason why the linear scan register allocation
-        algorithm does not handle liveness holes properly"""
-        inst_index = 0
-        min_gen = {}
-        max_use = {}
-        vars = set()
+        """computes liveness intervals for the function, in CFG order"""
+        # list of all variables; the id of a variable is its index
+        self.allvars = []
+        ids = {}
+        # ranges of points occupied by each variable, as [first, last] pairs
+        self.ranges = []
+        # weighted number of definitions and uses of each variable
+        self.uses = []
+        self.defs = []
+        # temporaries live across a call
+        self.crosscall = set()
+
+        def occupy(var, point):
+            if var not in ids:
+                ids[var] = len(self.allvars)
+                self.allvars.append(var)
+                self.ranges.append([])
+                self.uses.append(0)
+                self.defs.append([])
+            ranges = self.ranges[ids[var]]
+            if ranges and ranges[-1][1] >= point - 1:
+                ranges[-1][1] = point
+            else:
+                ranges.append([point, point])
 
-        for bb in self.cfg:
+        inst_index = 0
+        for bb in self.blocks:
             for i in bb.instrs:
                 try:
-                    kill = list(i.collect_kills())
+                    kill = remove_non_regs(i.collect_kills())
                 except AttributeError:
-                    kill = []
-                use = list(i.collect_uses())
-
-                kill = remove_non_regs(kill)
-                use = remove_non_regs(use)
-
+                    kill = set()
+                use = remove_non_regs(i.collect_uses())
+
+                for var in remove_non_regs(i.live_in) | use:
+                    occupy(var, 2 * inst_index)
+                for var in remove_non_regs(i.live_out) | kill:
+                    occupy(var, 2 * inst_index + 1)
+                for var in kill | use:
+                    self.uses[ids[var]] += self.freq[bb]
                 for var in kill:
-                    if not var in min_gen:
-                        min_gen[var] = inst_index
-                        max_use[var] = inst_index
-                for var in use:
-                    max_use[var] = inst_index
-
-                vars |= kill | use
+                    self.defs[ids[var]].append(i)
+                if is_call(i):
+                    self.crosscall |= remove_non_regs(i.live_out) - kill
 
                 inst_index += 1
 
-        for v in vars:
-            gen = min_gen[v]
-            kill = max_use[v]
-            self.varliveness.insert(0, {"var": v, "interv": range(gen, kill)})
-        self.varliveness.sort(key=lambda x: x['interv'][0])
-        self.allvars = list(vars)
+        self.start = [r[0][0] for r in self.ranges]
+        self.end = [r[-1][1] for r in self.ranges]
+        self.order = sorted(range(len(self.allvars)), key=lambda v: self.start[v])
+        self.remat = rematerializable({self.allvars[v]: self.defs[v] for v in range(len(self.allvars))})
+
+    def intersect(self, u, v):
+        """True if the intervals of u and v occupy a common point"""
+        a = self.ranges[u]
+        b = self.ranges[v]
+        i = j = 0
+        while i < len(a) and j < len(b):
+            if a[i][1] < b[j][0]:
+                i += 1
+            elif b[j][1] < a[i][0]:
+                j += 1
+            else:
+                return True
+        return False
+
+    def spill_cost(self, v):
+        """Uses per occupied point: spilling long intervals with few uses
+        frees the most registers for the least spill code. The temporaries
+        created by spilling cannot be shortened any further, while the ones
+        which can be rematerialized need no store and no memory access."""
+        if self.allvars[v] in self.reloads:
+            return float('inf')
+        cost = self.uses[v] / sum([last - first + 1 for first, last in self.ranges[v]])
+        if self.allvars[v] in self.remat:
+            return cost / 2
+        return cost
+
+    def allocate(self):
+        """Assign a register to each interval, in order of start point.
+        Returns the list of ids of the spilled intervals."""
+        reg = [None] * len(self.allvars)
+        assigned = {r: [] for r in range(0, self.nregs - 2)}  # -2 for spill room
+        spilled = []
+
+        for v in self.order:
+            blockers = {}
+            for r in assigned:
+                # forget the intervals which ended or were spilled
+                assigned[r] = [u for u in assigned[r] if self.end[u] >= self.start[v] and reg[u] == r]
+                blockers[r] = [u for u in assigned[r] if self.intersect(u, v)]
+
+            free = [r for r in assigned if not blockers[r]]
+            if free:
+                reg[v] = choose_register(free, self.allvars[v] in self.crosscall)
+            else:
+                # spill the cheapest set of intervals; on equal costs, the
+                # ones which last longer
+                def key(ids):
+                    return sum([self.spill_cost(u) for u in ids]), -max([self.end[u] for u in ids])
+
+                r = min(assigned, key=lambda r: key(blockers[r]))
+                if key(blockers[r]) < key([v]):
+                    for u in blockers[r]:
+                        reg[u] = SPILL_FLAG
+                        spilled.append(u)
+                    reg[v] = r
+                else:
+                    reg[v] = SPILL_FLAG
+                    spilled.append(v)
+            if reg[v] != SPILL_FLAG:
+                assigned[reg[v]].append(v)
+
+        self.vartoreg = {self.allvars[v]: reg[v] for v in range(len(self.allvars))}
+        return spilled
 
     def __call__(self):
         """Linear-scan register allocation (a variant of the more general
                 graph coloring algorithm known as "left-edge")"""
 
-        self.compute_liveness_intervals()
-        print('LIVENESS INTERVALS:')
-        print(self.varliveness)
-
-        live = []
-        freeregs = set(range(0, self.nregs - 2))  # -2 for spill room
-        numspill = 0
-
-        for livei in self.varliveness:
-            start = livei["interv"][0]
-
-            # expire old intervals
-            i = 0
-            while i < len(live):
-                notlivecandidate = live[i]
-                if notlivecandidate["interv"][-1] < start:
-                    live.pop(i)
-                    freeregs.add(self.vartoreg[notlivecandidate["var"]])
-                i += 1
-
-            if len(freeregs) == 0:
-                tospill = live[-1]
-                # keep the longest interval
-                if tospill["interv"][-1] > livei["interv"][-1]:
-                    # we have to spill "tospill"
-                    self.vartoreg[livei["var"]] = self.vartoreg[tospill["var"]]
-                    self.vartoreg[tospill["var"]] = SPILL_FLAG
-                    live.pop(-1)  # remove spill from active
-                    live.append(livei)  # add i to active
+        for round in range(SPILL_ROUNDS + 1):
+            self.compute_liveness_intervals()
+            print('LIVENESS INTERVALS OF', function_name(self.block) + ':')
+            print([(self.allvars[v], self.ranges[v]) for v in self.order])
+            spilled = self.allocate()
+            if not spilled or round == SPILL_ROUNDS:
+                break
+            self.spill_to_stack(set([self.allvars[v] for v in spilled]) - self.reloads)
+            self.cfg.function_liveness(self.blocks)
+
+        print('Linear scan of', function_name(self.block) + ':', self.stackslots, 'temporaries spilled to the stack,', self.rematerialized,
+              'rematerialized,', len(spilled), 'filled at each use')
+        return RegisterAllocation(self.vartoreg, len(spilled), self.nregs, self.block)
+
+
+def allocate_registers(cfg, nregs, allocator=LinearScanRegisterAllocator, profile=None):
+    """Run 'allocator' separately on each function of the CFG. 'profile' maps
+    each BB to its execution count, if available.
+    Returns the RegisterAllocation of the whole program."""
+    freq = block_frequencies(cfg, profile)
+    res = RegisterAllocation({}, 0, nregs)
+    for blocks in cfg.functions():
+        res.update(allocator(cfg, blocks, nregs, freq)())
+    return res
+
+
+def benchmark(sizes=(1000, 10000, 100000), window=16):
+    """Time the allocation of straight-line functions computing
+    t[i] = t[i - 1] + t[i - window], which keep 'window' temporaries live at
+    each instruction"""
+    import contextlib
+    import io
+    import time
+    from ir import SymbolTable, StatList, Block, DefinitionList, LoadImmStat, BinStat, PrintCommand, \
+        new_temporary, TYPENAMES
+
+    for n in sizes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            symtab = SymbolTable()
+            body = StatList(symtab=symtab)
+            temps = [new_temporary(symtab, TYPENAMES['int']) for i in range(n)]
+            for i in range(n):
+                if i < window:
+                    body.append(LoadImmStat(dest=temps[i], val=i, symtab=symtab))
                 else:
-                    self.vartoreg[livei["var"]] = SPILL_FLAG
-                numspill += 1
-
-            else:
-                self.vartoreg[livei["var"]] = freeregs.pop()
-                live.append(livei)
-
-            # sort the active intervals by increasing end point
-            live.sort(key=lambda li: li['interv'][-1])
-
-        return RegisterAllocation(self.vartoreg, numspill, self.nregs)
-
+                    body.append(BinStat(dest=temps[i], op='plus', srca=temps[i - 1], srcb=temps[i - window],
+                                        symtab=symtab))
+            body.append(PrintCommand(src=temps[-1], symtab=symtab))
+            cfg = CFG(Block(gl_sym=symtab, lc_sym=SymbolTable(), defs=DefinitionList(), body=body))
+            cfg.liveness()
+            start = time.time()
+            ra = allocate_registers(cfg, 11)
+            elapsed = time.time() - start
+        print(n, 'temporaries:', '{:.2f}'.format(elapsed), 's,', ra.numspill, 'spilled')
+
+
+if __name__ == '__main__':
+    benchmark()
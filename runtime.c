@@ -1,4 +1,5 @@
 #include <stdio.h>
+#include <stdlib.h>
 
 /* Use a C compiler to assemble and link a compiled program with the runtime:
  *   cc runtime.c out.s -o out
@@ -23,6 +24,34 @@ int __pl0_read(void)
 }
 
 
+/* Signed division, rounding towards zero, for the divisors which are not
+ * constant. The divisor is aligned with the most significant bit of the
+ * dividend, so that the loop runs once for each bit of the quotient. */
+int __pl0_div(int a, int b)
+{
+  unsigned int n, d, q, bit;
+
+  if (b == 0) {
+    fprintf(stderr, "division by zero\n");
+    exit(1);
+  }
+  n = a < 0 ? -(unsigned int)a : (unsigned int)a;
+  d = b < 0 ? -(unsigned int)b : (unsigned int)b;
+  q = 0;
+  if (n >= d) {
+    bit = __builtin_clz(d) - __builtin_clz(n);
+    d <<= bit;
+    for (bit = 1u << bit; bit; bit >>= 1, d >>= 1) {
+      if (n >= d) {
+        n -= d;
+        q |= bit;
+      }
+    }
+  }
+  return (a < 0) != (b < 0) ? (int)-q : (int)q;
+}
+
+
 int main(int argc, char *argv[])
 {
   __pl0_start();
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""List scheduling of the generated code of each function, for the in-order
+pipeline of ARMv6 cores (ARM11).
+
+The code is split into regions of straight-line code, delimited by labels,
+branches, calls, pushes and pops, and directives. The instructions of each
+region form a dependence graph: an instruction depends on the instructions
+which write the registers (or the flags) it reads, on the ones which read or
+write the registers it writes, and on the memory accesses it may alias.
+Accesses through the same base register at disjoint offsets do not alias.
+The instructions are then issued one per cycle, choosing each time among
+the ones whose operands are ready the one on the longest path to the end of
+the region, so that the instructions independent of a load or of a multiply
+fill the cycles its consumer would otherwise stall for.
+
+The code is scheduled after register allocation, and all the dependences
+on registers are kept: the order of the instructions changes, but no live
+range grows past the next write of its register, so the register pressure
+is the same as in the original code and no spill code is needed. Among the
+instructions on equally long paths the original order is preserved, which
+keeps the live ranges chosen by the allocator."""
+
+import re
+
+# cycles from the issue of an instruction to the issue of the first
+# instruction which can use its result without stalling
+LATENCY = {'ldr': 3, 'ldrb': 3, 'ldrh': 3, 'ldrsb': 3, 'ldrsh': 3,
+           'mul': 3, 'mla': 3, 'smull': 4, 'umull': 4, 'smmul': 4, 'smmla': 4}
+DEFAULT_LATENCY = 1
+
+DATA_PROCESSING = ['mov', 'mvn', 'add', 'sub', 'rsb', 'and', 'orr', 'eor', 'bic', 'lsl', 'lsr', 'asr', 'ror']
+COMPARISONS = ['cmp', 'cmn', 'tst', 'teq']
+MULTIPLIES = ['mul', 'mla', 'smull', 'umull', 'smmul', 'smmla']
+LOADS = {'ldr': 4, 'ldrb': 1, 'ldrh': 2, 'ldrsb': 1, 'ldrsh': 2}  # mnemonic -> bytes accessed
+STORES = {'str': 4, 'strb': 1, 'strh': 2}
+CONDITIONS = ['eq', 'ne', 'cs', 'hs', 'cc', 'lo', 'mi', 'pl', 'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le', 'al']
+BASES = sorted(DATA_PROCESSING + COMPARISONS + MULTIPLIES + list(LOADS) + list(STORES), key=len, reverse=True)
+
+FLAGS = 'flags'
+
+
+def split_mnemonic(mnemonic):
+    """Return the base instruction, whether it sets the flags, and whether it
+    is conditional; None if the instruction is not scheduled"""
+    for base in BASES:
+        if mnemonic.startswith(base):
+            rest = mnemonic[len(base):]
+            setflags = rest.startswith('s') and rest[1:] in CONDITIONS + ['']
+            if setflags:
+                rest = rest[1:]
+            if rest == '' or rest in CONDITIONS:
+                return base, setflags, rest not in ('', 'al')
+    return None
+
+
+def registers(operand):
+    regs = re.findall(r'\b(r\d+|sp|lr|pc|fp|ip)\b', operand)
+    return [{'fp': 'r11', 'ip': 'r12'}.get(r, r) for r in regs]
+
+
+def split_operands(operands):
+    """Split at the commas outside of brackets and braces"""
+    res = ['']
+    depth = 0
+    for c in operands:
+        if c in '[{':
+            depth += 1
+        elif c in ']}':
+            depth -= 1
+        if c == ',' and depth == 0:
+            res.append('')
+        else:
+            res[-1] += c
+    return [op.strip() for op in res]
+
+
+class Instruction(object):
+    """A machine instruction, with the registers it reads and writes and
+    the memory it accesses"""
+
+    def __init__(self, line, base, setflags, conditional, operands):
+        self.line = line
+        self.base = base
+        self.latency = LATENCY.get(base, DEFAULT_LATENCY)
+        self.defs = []
+        self.uses = []
+        self.access = None  # (base register, offset or None, size)
+        self.store = base in STORES
+        if base in COMPARISONS:
+            self.uses = registers(','.join(operands))
+        elif base in ('smull', 'umull'):
+            self.defs = registers(','.join(operands[:2]))
+            self.uses = registers(','.join(operands[2:]))
+        elif base in LOADS or base in STORES:
+            address = operands[1]
+            if base in LOADS:
+                self.defs = registers(operands[0])
+            else:
+                self.uses = registers(operands[0])
+            if address.startswith('['):
+                self.uses += registers(address)
+                self.access = self.memory_access(address, LOADS.get(base, STORES.get(base)))
+        else:
+            self.defs = registers(operands[0])
+            self.uses = registers(','.join(operands[1:]))
+        if setflags or base in COMPARISONS:
+            self.defs.append(FLAGS)
+        if conditional:
+            # when not executed, the destinations keep their old value
+            self.uses += [FLAGS] + self.defs
+
+    @staticmethod
+    def memory_access(address, size):
+        match = re.match(r'\[\s*(\w+)\s*(?:,\s*#(-?\d+))?\s*\]$', address)
+        if not match:
+            return (None, None, size)
+        base = registers(match.group(1))[0] if registers(match.group(1)) else None
+        offset = int(match.group(2)) if match.group(2) is not None else (0 if base else None)
+        return (base, offset, size)
+
+    def aliases(self, other):
+        """True if the memory accessed by the two instructions may overlap"""
+        base, offset, size = self.access
+        obase, ooffset, osize = other.access
+        if base is None or base != obase or offset is None or ooffset is None:
+            return True
+        return offset < ooffset + osize and ooffset < offset + size
+
+
+def parse(line):
+    """The Instruction on a line of assembly, or None if the line ends a
+    scheduling region"""
+    code = line.split('@')[0].strip()
+    if not line.startswith('\t') or not code or code.startswith('.'):
+        return None
+    parts = code.split(None, 1)
+    split = split_mnemonic(parts[0])
+    if split is None or len(parts) < 2:
+        return None
+    operands = split_operands(parts[1])
+    if len(operands) < 2 or '!' in parts[1] or re.search(r'\]\s*,', parts[1]):
+        # writeback and post-indexed addressing are not tracked
+        return None
+    instr = Instruction(line, split[0], split[1], split[2], operands)
+    if 'pc' in instr.defs:
+        return None
+    return instr
+
+
+class Region(object):
+    """The dependence graph of a region of straight-line code"""
+
+    def __init__(self, instrs):
+        self.instrs = instrs
+        self.preds = {i: [] for i in instrs}  # instruction -> [(pred, latency)]
+        self.succs = {i: [] for i in instrs}
+        for k, i in enumerate(instrs):
+            for p in instrs[:k]:
+                latency = self.dependence(p, i)
+                if latency is not None:
+                    self.preds[i].append((p, latency))
+                    self.succs[p].append((i, latency))
+        self.height = {}
+        for i in reversed(instrs):
+            self.height[i] = max([i.latency] + [lat + self.height[s] for s, lat in self.succs[i]])
+
+    @staticmethod
+    def dependence(p, i):
+        """The minimum distance in cycles between the issue of p and the issue
+        of i, if i depends on p"""
+        if set(p.defs) & set(i.uses):
+            return p.latency
+        if set(p.uses) & set(i.defs) or set(p.defs) & set(i.defs):
+            return 1
+        if p.access and i.access and (p.store or i.store) and p.aliases(i):
+            return 1
+        return None
+
+    def cycles(self, order):
+        """Estimated cycles taken by the region when issued in 'order'"""
+        issue = {}
+        cycle = 0
+        for i in order:
+            cycle = max([cycle] + [issue[p] + lat for p, lat in self.preds[i]])
+            issue[i] = cycle
+            cycle += 1
+        return cycle
+
+    def schedule(self):
+        order = []
+        position = {i: k for k, i in enumerate(self.instrs)}
+        waiting = {i: len(self.preds[i]) for i in self.instrs}
+        earliest = {i: 0 for i in self.instrs}
+        ready = [i for i in self.instrs if waiting[i] == 0]
+        cycle = 0
+        while ready:
+            issuable = [i for i in ready if earliest[i] <= cycle]
+            if not issuable:
+                cycle = min([earliest[i] for i in ready])
+                continue
+            best = max(issuable, key=lambda i: (self.height[i], -position[i]))
+            ready.remove(best)
+            order.append(best)
+            for s, lat in self.succs[best]:
+                earliest[s] = max(earliest[s], cycle + lat)
+                waiting[s] -= 1
+                if waiting[s] == 0:
+                    ready.append(s)
+            cycle += 1
+        return order
+
+
+def schedule_code(code, name):
+    """Schedule the instructions of the code of a function, and report the
+    estimated cycles saved. Returns the scheduled code."""
+    lines = code.split('\n')
+    res = []
+    region = []
+    before = 0
+    after = 0
+
+    def flush():
+        nonlocal before, after
+        if len(region) > 1:
+            graph = Region(region)
+            order = graph.schedule()
+            old, new = graph.cycles(region), graph.cycles(order)
+            if new > old:
+                order, new = region, old
+            before += old
+            after += new
+            res.extend([i.line for i in order])
+        else:
+            res.extend([i.line for i in region])
+        del region[:]
+
+    for line in lines:
+        instr = parse(line)
+        if instr is None:
+            flush()
+            res.append(line)
+        else:
+            region.append(instr)
+    flush()
+    print('Scheduling of', name + ': estimated', before, 'cycles before,', after, 'after, saved', before - after)
+    return '\n'.join(res)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""Induction variable analysis and strength reduction.
+
+A basic induction variable is a temporary whose only definition inside a loop
+is 'i <- i plus c' or 'i <- i minus c', with c loop-invariant. A derived
+induction variable is a temporary defined once as a linear function of an
+induction variable and of loop-invariant temporaries:
+    j = i * f1 * f2 ... + o1 * g1 ... - o2 * h1 ...
+Derived induction variables which require a multiplication (such as the
+addresses computed when indexing arrays) are replaced by a new temporary,
+initialized in the preheader and incremented together with the basic induction
+variable.
+
+Linear-function test replacement then rewrites the exit test of the loop in
+terms of a reduced variable, so that the original counter can be removed if
+it has no other uses."""
+
+from ir import *
+from loops import *
+from deadcode import is_pure
+from valuenumbering import count_definitions
+
+RELATIONAL_OPS = ['lss', 'leq', 'gtr', 'geq', 'eql', 'neq']
+MIRRORED_OPS = {'lss': 'gtr', 'leq': 'geq', 'gtr': 'lss', 'geq': 'leq', 'eql': 'eql', 'neq': 'neq'}
+
+
+class InductionVariable(object):
+    """Linear function basic * product(factors) + sum(sign * term * product(term factors))"""
+
+    def __init__(self, basic, factors=None, offsets=None):
+        self.basic = basic
+        self.factors = factors if factors else []
+        self.offsets = offsets if offsets else []  # list of (sign, temporary, factors)
+
+    def scaled(self, factor):
+        return InductionVariable(self.basic, self.factors + [factor],
+                                 [(sign, t, fs + [factor]) for sign, t, fs in self.offsets])
+
+    def shifted(self, sign, term):
+        return InductionVariable(self.basic, self.factors, self.offsets + [(sign, term, [])])
+
+
+class StrengthReduction(object):
+    def __init__(self, cfg, loop, preheader, consts, stats):
+        self.cfg = cfg
+        self.loop = loop
+        self.preheader = preheader
+        self.consts = consts  # temporary -> constant value, for single-definition LoadImmStat
+        self.stats = stats
+        self.symtab = preheader.instrs[0].symtab
+        self.defcount = count_definitions(cfg)
+        self.loopdefs = {}
+        for bb in loop.blocks:
+            for i in bb.instrs:
+                for var in i.collect_kills():
+                    if var.alloct == 'reg':
+                        self.loopdefs.setdefault(var, []).append((bb, i))
+
+    def invariant(self, var):
+        return var.alloct == 'reg' and var not in self.loopdefs
+
+    def find_basic(self):
+        """Map each basic induction variable to its increment (bb, instr, op, step)"""
+        self.basic = {}
+        for var, defs in self.loopdefs.items():
+            if len(defs) != 1:
+                continue
+            bb, i = defs[0]
+            if not isinstance(i, BinStat) or i.op not in ['plus', 'minus']:
+                continue
+            if i.srca is var and self.invariant(i.srcb):
+                self.basic[var] = (bb, i, i.op, i.srcb)
+            elif i.op == 'plus' and i.srcb is var and self.invariant(i.srca):
+                self.basic[var] = (bb, i, i.op, i.srca)
+
+    def derive(self, bb, pos, i):
+        """Return the InductionVariable computed by an instruction, or None"""
+        if isinstance(i, UnaryStat) and i.op == 'plus':
+            return self.operand_iv(bb, pos, i.src)
+        if not isinstance(i, BinStat) or i.op not in ['plus', 'minus', 'times']:
+            return None
+        for iv, other in [(i.srca, i.srcb), (i.srcb, i.srca)]:
+            if not self.invariant(other):
+                continue
+            ivar = self.operand_iv(bb, pos, iv)
+            if ivar is None:
+                continue
+            if i.op == 'times':
+                return ivar.scaled(other)
+            if i.op == 'plus':
+                return ivar.shifted('plus', other)
+            if iv is i.srca:
+                return ivar.shifted('minus', other)
+        return None
+
+    def operand_iv(self, bb, pos, var):
+        """Induction variable held by an operand of the instruction at position
+        'pos' of 'bb'. A derived variable can be used only in the BB which
+        defines it, and only if the basic variable is not incremented in
+        between."""
+        if var in self.basic:
+            return InductionVariable(var)
+        if var not in self.derived:
+            return None
+        dbb, di = self.loopdefs[var][0]
+        if dbb is not bb or bb.instrs.index(di) >= pos:
+            return None
+        incbb, inc = self.basic[self.derived[var].basic][0:2]
+        if incbb is bb and bb.instrs.index(di) < bb.instrs.index(inc) < pos:
+            return None
+        return self.derived[var]
+
+    def find_derived(self):
+        self.derived = {}
+        changed = True
+        while changed:
+            changed = False
+            for bb in self.loop.blocks:
+                for pos, i in enumerate(bb.instrs):
+                    try:
+                        dest = i.dest
+                    except AttributeError:
+                        continue
+                    if dest.alloct != 'reg' or dest in self.derived or dest in self.basic or \
+                            self.defcount.get(dest, 0) != 1:
+                        continue
+                    ivar = self.derive(bb, pos, i)
+                    if ivar is not None:
+                        self.derived[dest] = ivar
+                        changed = True
+
+    def emit(self, instrs, instr):
+        instrs.append(instr)
+        return instr.dest
+
+    def product(self, instrs, factors, value=None):
+        """Emit the instructions computing value * product(factors). Constant
+        factors are folded at compile time. Returns the resulting temporary."""
+        const = 1
+        variables = []
+        for f in factors:
+            if f in self.consts:
+                const *= self.consts[f]
+            else:
+                variables.append(f)
+        if value is None and not variables:
+            return self.emit(instrs, LoadImmStat(dest=new_temporary(self.symtab, TYPENAMES['int']), val=const,
+                                                 symtab=self.symtab))
+        if value is None:
+            value = variables.pop(0)
+        if const != 1:
+            variables.append(self.emit(instrs, LoadImmStat(dest=new_temporary(self.symtab, TYPENAMES['int']),
+                                                           val=const, symtab=self.symtab)))
+        for f in variables:
+            value = self.emit(instrs, BinStat(dest=new_temporary(self.symtab, TYPENAMES['int']), op='times',
+                                              srca=value, srcb=f, symtab=self.symtab))
+        return value
+
+    def evaluate(self, instrs, ivar, value, dest):
+        """Emit the instructions computing the linear function 'ivar' of
+        'value' into 'dest'"""
+        res = self.product(instrs, ivar.factors, value)
+        for sign, term, factors in ivar.offsets:
+            term = self.product(instrs, factors, term) if factors else term
+            res = self.emit(instrs, BinStat(dest=new_temporary(self.symtab, dest.stype), op=sign, srca=res,
+                                            srcb=term, symtab=self.symtab))
+        if instrs and instrs[-1].dest is res:
+            instrs[-1].dest = dest
+        else:
+            instrs.append(UnaryStat(dest=dest, op='plus', src=res, symtab=self.symtab))
+
+    def scale(self, ivar):
+        """Constant value of the product of the factors of an induction
+        variable, or None if it is not known at compile time"""
+        res = 1
+        for f in ivar.factors:
+            if f not in self.consts:
+                return None
+            res *= self.consts[f]
+        return res
+
+    def candidates(self, uses):
+        """Derived variables to be reduced: those which need a multiplication
+        and are not only used to compute another derived variable"""
+        res = []
+        for var, ivar in self.derived.items():
+            if self.scale(ivar) == 1:
+                continue
+            if all([isinstance(i, (BinStat, UnaryStat)) and i.dest in self.derived and self.derived[i.dest].factors
+                    for bb, i in uses.get(var, [])]):
+                continue
+            res.append(var)
+        return res
+
+    def reduce(self, var):
+        ivar = self.derived[var]
+        incbb, inc, op, step = self.basic[ivar.basic]
+        reduced = new_temporary(self.symtab, var.stype)
+        init = []
+        self.evaluate(init, ivar, ivar.basic, reduced)
+        delta = self.product(init, ivar.factors + [step])
+        self.preheader.append_instrs(init)
+
+        update = BinStat(inc.parent, dest=reduced, op=op, srca=reduced, srcb=delta, symtab=inc.symtab)
+        incbb.instrs.insert(incbb.instrs.index(inc) + 1, update)
+        bb, i = self.loopdefs[var][0]
+        bb.forward_value(i, var, reduced, self.cfg.collect_uses(), True)
+        self.reduced.setdefault(ivar.basic, []).append((reduced, ivar))
+        self.stats['reduced'] += 1
+
+    def remove_dead(self):
+        """Remove the computations of the loop (and of its preheader) left
+        without uses"""
+        blocks = self.loop.blocks + [self.preheader]
+        changed = True
+        while changed:
+            changed = False
+            uses = self.cfg.collect_uses()
+            for bb in blocks:
+                dead = set([i for i in bb.instrs if is_pure(i) and
+                            all([ui is i for ubb, ui in uses.get(i.dest, [])])])
+                if dead:
+                    bb.remove_instrs(dead)
+                    self.stats['removed'] += len(dead)
+                    changed = True
+
+    def replace_test(self, basic):
+        """Linear-function test replacement: if the only use of a basic
+        induction variable is the exit test, compare a reduced variable
+        instead"""
+        incbb, inc, op, step = self.basic[basic]
+        uses = [i for bb, i in self.cfg.collect_uses().get(basic, []) if i is not inc]
+        if len(uses) != 1:
+            return
+        test = uses[0]
+        if not isinstance(test, BinStat) or test.op not in RELATIONAL_OPS or test not in self.loop.instrs():
+            return
+        bound = test.srcb if test.srca is basic else test.srca
+        if not self.invariant(bound):
+            return
+        for reduced, ivar in self.reduced.get(basic, []):
+            scale = self.scale(ivar)
+            if scale is None or scale == 0:
+                continue
+            newbound = new_temporary(self.symtab, reduced.stype)
+            init = []
+            self.evaluate(init, ivar, bound, newbound)
+            self.preheader.append_instrs(init)
+            relop = test.op if scale > 0 else MIRRORED_OPS[test.op]
+            if test.srca is basic:
+                test.srca, test.srcb, test.op = reduced, newbound, relop
+            else:
+                test.srca, test.srcb, test.op = newbound, reduced, relop
+            self.stats['tests'] += 1
+            return
+
+    def __call__(self):
+        self.find_basic()
+        self.find_derived()
+        self.reduced = {}
+        for var in self.candidates(self.cfg.collect_uses()):
+            self.reduce(var)
+        if self.reduced:
+            self.remove_dead()
+            for basic in self.reduced:
+                self.replace_test(basic)
+            self.remove_dead()
+
+
+def find_constants(cfg):
+    """Map the temporaries defined only by a LoadImmStat to their value"""
+    defcount = count_definitions(cfg)
+    consts = {}
+    for bb in cfg:
+        for i in bb.instrs:
+            if isinstance(i, LoadImmStat) and defcount[i.dest] == 1:
+                consts[i.dest] = i.val
+    return consts
+
+
+def strength_reduction(cfg):
+    """Strength-reduce the induction variables of all the loops of the program"""
+    stats = {'reduced': 0, 'tests': 0, 'removed': 0}
+    for entry in [func[0] for func in cfg.functions()]:
+        for loop, preds, dom in loops_innermost_first(cfg, entry):
+            preheader = get_preheader(cfg, loop, preds)
+            StrengthReduction(cfg, loop, preheader, find_constants(cfg), stats)()
+    cfg.update_ir()
+    print('Strength reduction: reduced', stats['reduced'], 'induction variables, replaced', stats['tests'],
+          'loop tests, removed', stats['removed'], 'instructions')
+    return stats
@@ -9,15 +9,16 @@ applied to multiple IR nodes."""
 def get_node_list(root):
     """Get a list of all nodes in the AST"""
 
-    def register_nodes(l):
+    def register_nodes(l, seen):
         def r(node):
-            if node not in l:
+            if id(node) not in seen:
+                seen.add(id(node))
                 l.append(node)
 
         return r
 
     node_list = []
-    root.navigate(register_nodes(node_list))
+    root.navigate(register_nodes(node_list, set()))
     return node_list
 
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Tail call optimization. Works on the lowered and flattened IR tree.
+
+A call is in tail position when only empty statements and jumps separate it
+from the end of the function. The frame of the caller is not needed after
+such a call, so the code generator tears it down and jumps to the callee,
+which then returns directly to the caller of the current function.
+Tail calls of a procedure to itself are replaced by a jump to the beginning
+of its body, which turns the recursion into a loop."""
+
+from ir import *
+
+
+def in_tail_position(stats, pos):
+    """True if the statement at index 'pos' of a function body is followed
+    only by empty statements and unconditional jumps to the end of the
+    function"""
+    visited = set()
+    pos += 1
+    while pos < len(stats):
+        if pos in visited:
+            return False  # endless loop
+        visited.add(pos)
+        stat = stats[pos]
+        if isinstance(stat, BranchStat) and stat.is_unconditional() and not stat.returns:
+            targets = [i for i in range(len(stats)) if stats[i].get_label() is stat.target]
+            if not targets:
+                return False
+            pos = targets[0]
+        elif isinstance(stat, EmptyStat):
+            pos += 1
+        else:
+            return False
+    return True
+
+
+def tail_calls(stats):
+    return [stat for pos, stat in enumerate(stats) if isinstance(stat, BranchStat) and stat.returns and
+            stat.is_unconditional() and in_tail_position(stats, pos)]
+
+
+def loop_entry(body):
+    """Insert a label at the beginning of a function body. An empty statement
+    is left before it, so that the entry of the function stays outside of
+    the loop and can be used as its preheader."""
+    label = TYPENAMES['label']()
+    entry = EmptyStat(body, symtab=body.symtab)
+    entry.set_label(label)
+    body.children[0:0] = [EmptyStat(body, symtab=body.symtab), entry]
+    return label
+
+
+def tail_call_optimization(root):
+    """Mark the calls in tail position, and turn tail recursion into loops.
+    Returns the number of calls transformed."""
+    bodies = [('global', root.body)] + [(fdef.symbol, fdef.body.body) for fdef in root.defs.children]
+    calls = 0
+    loops = 0
+    for proc, body in bodies:
+        label = None
+        for call in tail_calls(body.children):
+            if call.target is proc:
+                if label is None:
+                    label = loop_entry(body)
+                jump = BranchStat(body, target=label, symtab=call.symtab)
+                if call.get_label():
+                    jump.set_label(call.get_label())
+                body.children[body.children.index(call)] = jump
+                loops += 1
+            else:
+                call.tail = True
+                calls += 1
+    print('Tail call optimization:', calls, 'tail calls,', loops, 'tail recursive calls turned into loops')
+    return calls + loops
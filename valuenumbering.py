@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""Local value numbering pass. Removes redundant computations and loads
+inside each basic block.
+
+Each temporary is mapped to a value number; two instructions which compute
+the same operation on the same value numbers produce the same value, so the
+second one can be removed and its destination replaced by the first one.
+Loads from memory are numbered as well, until a store or a call which may
+modify the same memory location is found."""
+
+from ir import *
+from modref import call_may_modify
+
+COMMUTATIVE_OPS = ['plus', 'times', 'eql', 'neq']
+
+
+def count_definitions(cfg):
+    """Number of instructions which define each temporary"""
+    defs = {}
+    for bb in cfg:
+        for i in bb.instrs:
+            try:
+                kills = i.collect_kills()
+            except AttributeError:
+                kills = []
+            for var in kills:
+                if var.alloct == 'reg':
+                    defs[var] = defs.get(var, 0) + 1
+    return defs
+
+
+def apply_renaming(cfg, renaming):
+    """Replace all the uses of the temporaries in the 'renaming' dictionary"""
+    for var in renaming:  # resolve chains of renamings
+        while renaming[var] in renaming:
+            renaming[var] = renaming[renaming[var]]
+    for bb in cfg:
+        for i in bb.instrs:
+            i.replace_uses(renaming)
+
+
+def access_size(ptr):
+    """Size in bits of the memory location accessed through a pointer"""
+    try:
+        return ptr.stype.pointstotype.size
+    except AttributeError:
+        return ptr.stype.size
+
+
+class ValueNumbering(object):
+    """Value numbering state for a single basic block"""
+
+    def __init__(self, defcount):
+        self.defcount = defcount
+        self.nextvn = 0
+        self.vn = {}  # temporary -> value number
+        self.holder = {}  # value number -> temporary which holds it
+        self.exprs = {}  # expression key -> value number
+        self.memory = {}  # memory location key -> (value number, base symbol)
+        self.base = {}  # value number of a pointer -> symbol it points into
+
+    def new_value(self, var=None):
+        vn = self.nextvn
+        self.nextvn += 1
+        if var is not None:
+            self.holder[vn] = var
+        return vn
+
+    def value_of(self, var):
+        if var not in self.vn:
+            self.vn[var] = self.new_value(var)
+        return self.vn[var]
+
+    def available(self, vn):
+        """Return the temporary holding the value vn, if any"""
+        var = self.holder.get(vn)
+        if var is not None and self.vn.get(var) == vn:
+            return var
+        return None
+
+    def single_def(self, var):
+        return self.defcount.get(var, 0) <= 1
+
+    def expression_key(self, i):
+        if isinstance(i, LoadImmStat):
+            return 'imm', i.val
+        if isinstance(i, LoadPtrToSym):
+            return 'addr', i.symbol
+        if isinstance(i, BinStat):
+            a, b = self.value_of(i.srca), self.value_of(i.srcb)
+            if i.op in COMMUTATIVE_OPS and b < a:
+                a, b = b, a
+            return 'bin', i.op, a, b, i.dest.stype.size
+        if isinstance(i, UnaryStat):
+            return 'un', i.op, self.value_of(i.src), i.dest.stype.size
+        return None
+
+    def memory_key(self, i):
+        """Key and base symbol of the memory location read by a LoadStat"""
+        if i.symbol.alloct == 'reg':
+            ptrvn = self.value_of(i.symbol)
+            return ('ptr', ptrvn, access_size(i.symbol)), self.base.get(ptrvn)
+        return ('sym', i.symbol), i.symbol
+
+    def kill_memory(self, may_alias):
+        self.memory = {k: v for k, v in self.memory.items() if not may_alias(v[1])}
+
+    def store(self, i):
+        srcvn = self.value_of(i.symbol)
+        if i.dest.alloct == 'reg':
+            ptrvn = self.value_of(i.dest)
+            base = self.base.get(ptrvn)
+            # a pointer derived from the address of a variable can only
+            # modify that variable; any other pointer can modify any memory
+            self.kill_memory(lambda b: b is None or base is None or b == base)
+            key = ('ptr', ptrvn, access_size(i.dest))
+        else:
+            base = i.dest
+            self.kill_memory(lambda b: b == base)
+            key = ('sym', i.dest)
+        if access_size(i.dest) == 32:
+            # the value in memory is not truncated: forward it to the next loads
+            self.memory[key] = (srcvn, base)
+
+    def call(self, i):
+        """A procedure can modify the global variables in its mod set (any
+        global variable, if unknown), but not the local variables of the
+        caller"""
+        self.kill_memory(lambda b: call_may_modify(i, b))
+
+    def define(self, dest, vn):
+        self.vn[dest] = vn
+        if self.available(vn) is None:
+            self.holder[vn] = dest
+
+    def visit(self, i, renaming):
+        """Number the values computed by an instruction. Returns True iff the
+        instruction is redundant and can be removed."""
+        if isinstance(i, BranchStat) and i.returns:
+            self.call(i)
+            return False
+        if isinstance(i, StoreStat):
+            self.store(i)
+            return False
+
+        if isinstance(i, UnaryStat) and i.op == 'plus':
+            vn = self.value_of(i.src)  # copy
+        elif isinstance(i, LoadStat):
+            key, base = self.memory_key(i)
+            if key in self.memory:
+                vn = self.memory[key][0]
+            else:
+                vn = self.new_value()
+                self.memory[key] = (vn, base)
+        else:
+            key = self.expression_key(i)
+            if key is None:
+                for var in i.collect_kills():
+                    if var.alloct == 'reg':
+                        self.define(var, self.new_value())
+                return False
+            if key in self.exprs:
+                vn = self.exprs[key]
+            else:
+                vn = self.new_value()
+                self.exprs[key] = vn
+            if isinstance(i, LoadPtrToSym):
+                self.base[vn] = i.symbol
+            elif isinstance(i, BinStat) and i.op in ['plus', 'minus']:
+                base = self.base.get(self.value_of(i.srca), self.base.get(self.value_of(i.srcb)))
+                if base is not None:
+                    self.base[vn] = base
+
+        holder = self.available(vn)
+        if holder is not None and holder != i.dest and self.single_def(holder) and self.single_def(i.dest):
+            renaming[i.dest] = holder
+            self.vn[i.dest] = vn
+            return True
+        self.define(i.dest, vn)
+        return False
+
+
+def local_value_numbering(cfg):
+    """Run value numbering on each basic block of the CFG. Returns the number
+    of instructions removed."""
+    defcount = count_definitions(cfg)
+    renaming = {}
+    removed = 0
+    for bb in cfg:
+        state = ValueNumbering(defcount)
+        dead = set()
+        for i in bb.instrs:
+            i.replace_uses(renaming)
+            if state.visit(i, renaming):
+                dead.add(i)
+        if len(dead):
+            bb.remove_instrs(dead)
+            removed += len(dead)
+    apply_renaming(cfg, renaming)
+    cfg.update_ir()
+    print('Value numbering: removed', removed, 'redundant instructions')
+    return removed